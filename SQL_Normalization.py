@@ -1,8 +1,19 @@
 ### Utility Functions
+import numpy as np
 import pandas as pd
 import sqlite3
 from sqlite3 import Error
-import datetime
+import functools
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
 
 def create_connection(db_file, delete_db=False):
@@ -14,6 +25,7 @@ def create_connection(db_file, delete_db=False):
     conn = None
     try:
         conn = sqlite3.connect(db_file)
+        trace_connection(conn)
         conn.execute("PRAGMA foreign_keys = 1")
     except Error as e:
         print(e)
@@ -37,115 +49,534 @@ def create_table(conn, create_table_sql, drop_table_name=None):
         print(e)
 
 
-def execute_sql_statement(sql_statement, conn):
+def execute_sql_statement(sql_statement, conn, parameters=()):
     cur = conn.cursor()
-    cur.execute(sql_statement)
+    cur.execute(sql_statement, parameters)
 
     rows = cur.fetchall()
 
     return rows
 
 
-def step1_create_region_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
-    # Output: None
+INSERT_BATCH_SIZE = 100000
+
+
+def execute_many_sql_statement(sql_statement, rows, conn, batch_size=None):
+    # Binds every row to the same statement with executemany. With batch_size
+    # the rows are committed every batch_size rows (see commit), otherwise the
+    # caller commits.
+    import itertools
+
+    cur = conn.cursor()
+    if batch_size is None:
+        cur.executemany(sql_statement, rows)
+        count_rows("rows_inserted", cur.rowcount)
+        return
+
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        cur.executemany(sql_statement, batch)
+        count_rows("rows_inserted", cur.rowcount)
+        commit(conn)
+
+
+# Connections loading inside build_mode, see commit
+_building = set()
+
+
+def commit(conn):
+    # Commits conn unless it is loading inside build_mode. The loaders and
+    # table helpers commit through this, so on their own (the step functions)
+    # each one commits its work, while under build_mode the whole load stays
+    # one transaction that build_mode commits or rolls back at the end.
+
+    if conn not in _building:
+        conn.commit()
+
+
+def check_foreign_keys(conn):
+    # Verifies every foreign key of the database with one PRAGMA
+    # foreign_key_check, for loads that run with foreign_keys off. Uncommitted
+    # rows of conn are checked too, so a caller can roll back on a violation.
+    # Inputs: Open connection
+    # Output: None; raises sqlite3.IntegrityError if rows violate a foreign key
+
+    violations = execute_sql_statement("PRAGMA foreign_key_check;", conn)
+    if violations:
+        table_name, rowid, parent, _ = violations[0]
+        raise sqlite3.IntegrityError(
+            "%d rows violate a foreign key, e.g. %s row %s has no %s parent"
+            % (len(violations), table_name, rowid, parent)
+        )
+
+
+@contextmanager
+def build_mode(conn, cache_size_kib=262144, durable=False):
+    # Bulk-load profile for a connection that (re)builds the database: no fsyncs,
+    # an in-memory rollback journal (a WAL database keeps WAL), temp tables in
+    # memory, a large page cache and no per-insert foreign key checks. The load
+    # runs as a single transaction: commit does nothing on the connection until
+    # the block exits. On a clean exit every foreign key is verified once with
+    # check_foreign_keys and the transaction is committed; on an error it is
+    # rolled back, so the database is left as it was. The previous settings are
+    # restored either way. durable=True keeps the journal mode and fsyncs, for
+    # loads into a database whose existing contents must survive a crash.
+    # Inputs: Open connection, the page cache size in KiB to load with and
+    # whether to keep the journal durable
+    # Output: None; raises sqlite3.IntegrityError if rows violate a foreign key
+
+    conn.commit()
+    settings = {
+        pragma: execute_sql_statement("PRAGMA %s;" % pragma, conn)[0][0]
+        for pragma in ["synchronous", "temp_store", "cache_size", "foreign_keys"]
+    }
+    journal_mode = execute_sql_statement("PRAGMA journal_mode;", conn)[0][0]
+
+    memory_journal = journal_mode != "wal" and not durable
+    if memory_journal:
+        execute_sql_statement("PRAGMA journal_mode = MEMORY;", conn)
+    if not durable:
+        execute_sql_statement("PRAGMA synchronous = OFF;", conn)
+    execute_sql_statement("PRAGMA temp_store = MEMORY;", conn)
+    execute_sql_statement("PRAGMA cache_size = -%d;" % cache_size_kib, conn)
+    execute_sql_statement("PRAGMA foreign_keys = 0;", conn)
+    # An explicit BEGIN, as sqlite3 would otherwise run the DDL of the load
+    # (CREATE, DROP, ALTER TABLE) outside of the transaction
+    execute_sql_statement("BEGIN;", conn)
+    _building.add(conn)
+    try:
+        yield
+        check_foreign_keys(conn)
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        _building.discard(conn)
+        if memory_journal:
+            execute_sql_statement("PRAGMA journal_mode = %s;" % journal_mode, conn)
+        for pragma, value in settings.items():
+            execute_sql_statement("PRAGMA %s = %s;" % (pragma, value), conn)
+
+
+logger = logging.getLogger(__name__)
+
+# Callables that receive the measurement dict of every instrumented step and
+# report call, see instrumented.
+INSTRUMENTATION_CALLBACKS = []
+
+# Set to True to log every measurement at INFO through the module logger. The
+# logging configuration alone never turns instrumentation on.
+LOG_MEASUREMENTS = False
+
+_measurements = threading.local()
+
+
+def instrumentation_enabled():
+    # Output: True if a callback is registered or LOG_MEASUREMENTS is set
+
+    return bool(INSTRUMENTATION_CALLBACKS) or LOG_MEASUREMENTS
+
+
+def count_rows(counter, rows):
+    # Adds rows to a counter of every measurement running in this thread.
+    # Inputs: "rows_read", "rows_inserted" or "rows_returned" and the row count
+
+    for measurement in getattr(_measurements, "stack", ()):
+        measurement[counter] += rows
+
+
+def count_statement(sql_statement):
+    # Trace callback that counts every statement SQLite runs on a connection
+
+    for measurement in getattr(_measurements, "stack", ()):
+        measurement["statements"] += 1
+
+
+def trace_connection(conn):
+    # Counts the statements run on a connection opened during a measurement
+
+    if getattr(_measurements, "stack", None):
+        conn.set_trace_callback(count_statement)
+
+
+def peak_rss_kib():
+    # Output: Peak resident set size in KiB of this process or of its largest
+    # finished worker process, or None where the resource module is missing
+
+    if resource is None:
+        return None
+    peak_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    if sys.platform == "darwin":  # ru_maxrss is in bytes there
+        peak_rss //= 1024
+    return peak_rss
+
+
+def emit_measurement(measurement):
+    # Hands a finished measurement to every registered callback and, with
+    # LOG_MEASUREMENTS, the logger
+
+    for callback in list(INSTRUMENTATION_CALLBACKS):
+        callback(measurement)
+    if not LOG_MEASUREMENTS:
+        return
+    logger.info(
+        "%(name)s took %(seconds).3fs: %(rows_read)d rows read, "
+        "%(rows_inserted)d rows inserted, %(rows_returned)d rows returned, "
+        "%(statements)d statements, peak RSS %(peak_rss_kib)s KiB",
+        measurement,
+    )
+
+
+def instrumented(function):
+    # Decorator for the step, load and report functions. When a callback is
+    # registered in INSTRUMENTATION_CALLBACKS or LOG_MEASUREMENTS is set, every
+    # call emits a dict with the function name, wall time, source rows read,
+    # rows inserted, report rows returned, SQLite statement executions (on
+    # connections passed in or opened during the call), peak RSS and the
+    # name of the exception it raised, if any. Nested calls count towards every
+    # enclosing measurement. Statements are counted through the connections'
+    # trace callback, so while instrumentation is on it replaces any callback
+    # set with set_trace_callback and clears it when the outermost measured
+    # call returns. Otherwise the function is called as is.
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not instrumentation_enabled():
+            return function(*args, **kwargs)
+
+        stack = _measurements.__dict__.setdefault("stack", [])
+        connections = [arg for arg in args if isinstance(arg, sqlite3.Connection)]
+        for conn in connections:
+            conn.set_trace_callback(count_statement)
+        measurement = {
+            "name": function.__name__,
+            "rows_read": 0,
+            "rows_inserted": 0,
+            "rows_returned": 0,
+            "statements": 0,
+            "error": None,
+        }
+        stack.append(measurement)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except BaseException as e:
+            measurement["error"] = type(e).__name__
+            raise
+        finally:
+            measurement["seconds"] = time.perf_counter() - start
+            stack.pop()
+            if not stack:
+                for conn in connections:
+                    conn.set_trace_callback(None)
+            measurement["peak_rss_kib"] = peak_rss_kib()
+            emit_measurement(measurement)
+
+    return wrapper
+
+
+def run_report_query(sql_statement, conn):
+    # Inputs: A report's SQL statement and an open connection
+    # Output: DataFrame with the result
+
+    df = pd.read_sql_query(sql_statement, conn)
+    count_rows("rows_returned", len(df))
+    return df
+
+
+DATA_COLUMNS = [
+    "Name",
+    "Address",
+    "City",
+    "Country",
+    "Region",
+    "ProductName",
+    "ProductCategory",
+    "ProductCategoryDescription",
+    "ProductUnitPrice",
+    "QuantityOrdered",
+    "OrderDate",
+]
+
+
+def read_data(data_filename, chunksize=None, header=0):
+    # Inputs: Name (or file object) of the tab-separated data file, an optional
+    # chunk size, and header=None for a part of the file without the header
+    # line
+    # Output: DataFrame with every source column kept as text, or an iterator of
+    # such DataFrames of chunksize rows each when chunksize is given. The
+    # customer columns repeat on every order, so they are read as categoricals:
+    # each distinct value is stored once and rows hold integer codes.
+
+    data = pd.read_csv(
+        data_filename,
+        on_bad_lines="skip",
+        header=header,
+        names=DATA_COLUMNS,
+        sep="\t",
+        dtype={
+            column: "category" if column in CUSTOMER_COLUMNS else str
+            for column in DATA_COLUMNS
+        },
+        chunksize=chunksize,
+    )
+    if chunksize is None:
+        count_rows("rows_read", len(data))
+    return data
+
+
+ORDER_LINE_COLUMNS = [
+    "ProductName",
+    "ProductCategory",
+    "ProductCategoryDescription",
+    "ProductUnitPrice",
+    "QuantityOrdered",
+    "OrderDate",
+]
+
+
+def explode_order_lines(data, columns=ORDER_LINE_COLUMNS):
+    # Inputs: The source DataFrame and the ;-joined columns to split, all of
+    # ORDER_LINE_COLUMNS by default
+    # Output: DataFrame with one row per order line, the ;-joined product columns
+    # split apart. The product columns and OrderDate are converted to
+    # categoricals, so the dimension dedup and key resolution work on codes.
+
+    order_lines = data[["Name"]].join(
+        data[columns].apply(lambda column: column.str.split(";"))
+    )
+    return order_lines.explode(columns, ignore_index=True).astype(
+        {
+            column: "category"
+            for column in PRODUCT_COLUMNS + ["OrderDate"]
+            if column in columns
+        }
+    )
+
+
+# The order line columns stage_order_lines reads
+STAGED_ORDER_LINE_COLUMNS = ["ProductName", "QuantityOrdered", "OrderDate"]
+
+
+CUSTOMER_COLUMNS = ["Name", "Address", "City", "Country", "Region"]
+PRODUCT_COLUMNS = [
+    "ProductName",
+    "ProductCategory",
+    "ProductCategoryDescription",
+    "ProductUnitPrice",
+]
+
+
+# Source rows per chunk when normalize collects the dimensions for a process
+# pool, which parses the order lines itself
+DIMENSION_CHUNK_SIZE = 100000
+
+
+def read_dimension_data(data_filename, chunksize):
+    # Scans the source chunksize rows at a time and keeps only the distinct
+    # dimension rows, so memory is bounded by the dimensions, not the file.
+    # Inputs: Name of the data file and the number of rows per chunk
+    # Output: (customers, products) DataFrames that stand in for the source
+    # DataFrame and the exploded order lines in the build_*_dimension functions
+
+    customers = pd.DataFrame(columns=CUSTOMER_COLUMNS)
+    products = pd.DataFrame(columns=PRODUCT_COLUMNS)
+    with read_data(data_filename, chunksize=chunksize) as chunks:
+        for chunk in chunks:
+            count_rows("rows_read", len(chunk))
+            customers = pd.concat(
+                [customers, chunk[CUSTOMER_COLUMNS].drop_duplicates()]
+            ).drop_duplicates()
+            chunk_products = explode_order_lines(chunk, PRODUCT_COLUMNS)
+            products = pd.concat(
+                [products, chunk_products[PRODUCT_COLUMNS].drop_duplicates()]
+            ).drop_duplicates()
+    return customers, products
+
+
+def build_region_dimension(data):
+    # Inputs: The source DataFrame
+    # Output: Sorted DataFrame of the distinct Regions
+
+    return (
+        data[["Region"]].drop_duplicates().sort_values("Region", ignore_index=True)
+    )
+
+
+def build_country_dimension(data):
+    # Inputs: The source DataFrame
+    # Output: Sorted DataFrame of the distinct (Country, Region) pairs
+
+    return (
+        data[["Country", "Region"]]
+        .drop_duplicates()
+        .sort_values(["Country", "Region"], ignore_index=True)
+    )
+
+
+def build_customer_dimension(data):
+    # Inputs: The source DataFrame
+    # Output: DataFrame of the distinct customers sorted by "FirstName LastName".
+    # The first word of Name is the FirstName, the remaining words the LastName.
+
+    customers = data[["Name", "Address", "City", "Country"]].drop_duplicates()
+    names = (
+        customers["Name"]
+        .str.strip()
+        .str.replace(r"\s+", " ", regex=True)
+        .str.split(" ", n=1, expand=True)
+        .reindex(columns=[0, 1])
+        .fillna("")
+        .astype(str)
+    )
+    customers = customers.assign(FirstName=names[0], LastName=names[1])
+    customers["Name"] = customers["FirstName"] + " " + customers["LastName"]
+    return (
+        customers.drop_duplicates()
+        .sort_values("Name", kind="stable", ignore_index=True)[
+            ["FirstName", "LastName", "Address", "City", "Country"]
+        ]
+    )
+
+
+def build_productcategory_dimension(order_lines):
+    # Inputs: DataFrame returned by explode_order_lines
+    # Output: Sorted DataFrame of the distinct (ProductCategory, ProductCategoryDescription) pairs
+
+    columns = ["ProductCategory", "ProductCategoryDescription"]
+    return (
+        order_lines[columns].drop_duplicates().sort_values(columns, ignore_index=True)
+    )
+
+
+def build_product_dimension(order_lines):
+    # Inputs: DataFrame returned by explode_order_lines
+    # Output: Sorted DataFrame of the distinct (ProductName, ProductUnitPrice, ProductCategory) rows
+
+    columns = ["ProductName", "ProductUnitPrice", "ProductCategory"]
+    return (
+        order_lines[columns].drop_duplicates().sort_values(columns, ignore_index=True)
+    )
+
+
+def load_region_table(conn, data):
+    # Inputs: Open connection and the source DataFrame
+    # Output: Dictionary mapping each Region to the RegionID it was assigned
 
-    ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
     create_table_sql = """CREATE TABLE Region (
         RegionID INTEGER NOT NULL PRIMARY KEY,
         Region TEXT NOT NULL );"""
-    insert_regions_sql = """INSERT INTO Region (Region) VALUES ('{}');"""
+    insert_regions_sql = """INSERT INTO Region (RegionID, Region) VALUES (?, ?);"""
 
-    create_table(conn, create_table_sql)
+    create_table(conn, create_table_sql, "Region")
 
-    data = pd.read_csv(data_filename, on_bad_lines="skip", header=0, sep="\t")
+    regions = build_region_dimension(data)["Region"].tolist()
+    region_to_regionid_dict = {region: i for i, region in enumerate(regions, 1)}
 
-    regions = set()
+    execute_many_sql_statement(
+        insert_regions_sql,
+        [(i, region) for region, i in region_to_regionid_dict.items()],
+        conn,
+    )
+    commit(conn)
+    return region_to_regionid_dict
 
-    for i in data.index:
-        regionName = data["Region"][i]
-        print(regionName)
-        regions.add(regionName)
 
-    regions = sorted(list(regions))
+@instrumented
+def step1_create_region_table(data_filename, normalized_database_filename):
+    # Inputs: Name of the data and normalized database filename
+    # Output: None
 
-    for region in regions:
-        execute_sql_statement(insert_regions_sql.format(region), conn)
-    conn.commit()
+    ### BEGIN SOLUTION
+    conn = create_connection(normalized_database_filename)
+    load_region_table(conn, read_data(data_filename))
     conn.close()
 
     ### END SOLUTION
 
 
+@instrumented
 def step2_create_region_to_regionid_dictionary(normalized_database_filename):
 
     ### BEGIN SOLUTION
     conn = create_connection(normalized_database_filename)
-    res = {}
-    df = pd.read_sql_query("select * from Region;", conn)
-    for i in df.index:
-        res[df["Region"][i]] = df["RegionID"][i]
+    res = dict(execute_sql_statement("select Region, RegionID from Region;", conn))
     conn.close()
     return res
 
     ### END SOLUTION
 
 
-def step3_create_country_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
-    # Output: None
+def load_country_table(conn, data, region_to_regionid_dict):
+    # Inputs: Open connection, the source DataFrame and the Region key map
+    # Output: Dictionary mapping each Country to the CountryID it was assigned
 
-    ### BEGIN SOLUTION
-    region_to_regionid_dict = step2_create_region_to_regionid_dictionary(
-        normalized_database_filename
-    )
-    conn = create_connection(normalized_database_filename)
     create_table_sql = """CREATE TABLE Country (
         CountryID INTEGER NOT NULL PRIMARY KEY,
         Country TEXT NOT NULL,
         RegionID INTEGER NOT NULL, FOREIGN KEY(RegionID) REFERENCES Region(RegionID) ON DELETE CASCADE ON UPDATE NO ACTION  );"""
     insert_country_sql = (
-        """INSERT INTO Country (Country, RegionID) VALUES ('{}', {});"""
+        """INSERT INTO Country (CountryID, Country, RegionID) VALUES (?, ?, ?);"""
+    )
+    country_region_combos = list(
+        build_country_dimension(data).itertuples(index=False, name=None)
     )
-    data = pd.read_csv(data_filename, on_bad_lines="skip", header=0, sep="\t")
-    country_region_combos = set()
-    for i in data.index:
-        country_region_combos.add((data["Country"][i], data["Region"][i]))
-    country_region_combos = sorted(list(country_region_combos))
     create_table(conn, create_table_sql, "Country")
 
-    for country, region in country_region_combos:
-        execute_sql_statement(
-            insert_country_sql.format(country, region_to_regionid_dict[region]), conn
-        )
-    conn.commit()
+    execute_many_sql_statement(
+        insert_country_sql,
+        [
+            (i, country, region_to_regionid_dict[region])
+            for i, (country, region) in enumerate(country_region_combos, 1)
+        ],
+        conn,
+    )
+    commit(conn)
+    return {
+        country: i for i, (country, region) in enumerate(country_region_combos, 1)
+    }
+
+
+@instrumented
+def step3_create_country_table(data_filename, normalized_database_filename):
+    # Inputs: Name of the data and normalized database filename
+    # Output: None
+
+    ### BEGIN SOLUTION
+    region_to_regionid_dict = step2_create_region_to_regionid_dictionary(
+        normalized_database_filename
+    )
+    conn = create_connection(normalized_database_filename)
+    load_country_table(conn, read_data(data_filename), region_to_regionid_dict)
     conn.close()
 
     ### END SOLUTION
 
 
+@instrumented
 def step4_create_country_to_countryid_dictionary(normalized_database_filename):
 
     ### BEGIN SOLUTION
     conn = create_connection(normalized_database_filename)
-    res = {}
-    df = pd.read_sql_query("select * from Country;", conn)
-    for i in df.index:
-        res[df["Country"][i]] = df["CountryID"][i]
+    res = dict(execute_sql_statement("select Country, CountryID from Country;", conn))
     conn.close()
     return res
 
     ### END SOLUTION
 
 
-def step5_create_customer_table(data_filename, normalized_database_filename):
+def load_customer_table(conn, data, country_to_countryid_dict):
+    # Inputs: Open connection, the source DataFrame and the Country key map
+    # Output: Dictionary mapping each "FirstName LastName" to its CustomerID
 
-    ### BEGIN SOLUTION
-    country_to_countryid_dict = step4_create_country_to_countryid_dictionary(
-        normalized_database_filename
-    )
-    conn = create_connection(normalized_database_filename)
     create_table_sql = """CREATE TABLE Customer (
         CustomerID INTEGER NOT NULL PRIMARY KEY,
         FirstName TEXT NOT NULL,
@@ -154,104 +585,162 @@ def step5_create_customer_table(data_filename, normalized_database_filename):
         City TEXT NOT NULL,
         CountryID INTEGER NOT NULL,
         FOREIGN KEY(CountryID) REFERENCES Country(CountryID) ON DELETE CASCADE ON UPDATE NO ACTION  );"""
-    insert_regions_sql = """INSERT INTO Customer (FirstName, LastName, Address, City, CountryID) VALUES ("{}", "{}", "{}", "{}", {});"""
-    data = pd.read_csv(data_filename, on_bad_lines="skip", header=0, sep="\t")
-    name_country_combos = set()
-    for i in data.index:
-        full_name = data["Name"][i]
-        name_parts = full_name.split()
-        first_name = name_parts[0]
-        last_name = " ".join(name_parts[1:])
-        address = data["Address"][i]
-        city = data["City"][i]
-        name_country_combos.add(
-            (first_name, last_name, address, city, data["Country"][i])
-        )
-    name_country_combos = sorted(
-        list(name_country_combos), key=lambda x: x[0] + " " + x[1]
+    insert_regions_sql = """INSERT INTO Customer (CustomerID, FirstName, LastName, Address, City, CountryID) VALUES (?, ?, ?, ?, ?, ?);"""
+    name_country_combos = list(
+        build_customer_dimension(data).itertuples(index=False, name=None)
     )
     create_table(conn, create_table_sql, "Customer")
-   
-    for first_name, last_name, address, city, country in name_country_combos:
-        sql_statement = insert_regions_sql.format(
-            first_name, last_name, address, city, country_to_countryid_dict[country]
-        )
-        execute_sql_statement(sql_statement, conn)
-    conn.commit()
+
+    execute_many_sql_statement(
+        insert_regions_sql,
+        [
+            (
+                i,
+                first_name,
+                last_name,
+                address,
+                city,
+                country_to_countryid_dict[country],
+            )
+            for i, (first_name, last_name, address, city, country) in enumerate(
+                name_country_combos, 1
+            )
+        ],
+        conn,
+    )
+    commit(conn)
+    return {
+        combo[0] + " " + combo[1]: i
+        for i, combo in enumerate(name_country_combos, 1)
+    }
+
+
+@instrumented
+def step5_create_customer_table(data_filename, normalized_database_filename):
+
+    ### BEGIN SOLUTION
+    country_to_countryid_dict = step4_create_country_to_countryid_dictionary(
+        normalized_database_filename
+    )
+    conn = create_connection(normalized_database_filename)
+    load_customer_table(conn, read_data(data_filename), country_to_countryid_dict)
     conn.close()
     ### END SOLUTION
 
 
+@instrumented
 def step6_create_customer_to_customerid_dictionary(normalized_database_filename):
 
     ### BEGIN SOLUTION
     conn = create_connection(normalized_database_filename)
-    res = {}
-    df = pd.read_sql_query("select * from Customer;", conn)
-    # print(df)
-    for i in df.index:
-        res[df["FirstName"][i] + " " + df["LastName"][i]] = df["CustomerID"][i]
+    res = dict(
+        execute_sql_statement(
+            "select FirstName || ' ' || LastName, CustomerID from Customer;", conn
+        )
+    )
     conn.close()
     return res
 
     ### END SOLUTION
 
 
-def step7_create_productcategory_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
-    # Output: None
+def load_productcategory_table(conn, order_lines):
+    # Inputs: Open connection and the DataFrame returned by explode_order_lines
+    # Output: Dictionary mapping each ProductCategory to its ProductCategoryID
 
-    ### BEGIN SOLUTION
-    conn = create_connection(normalized_database_filename)
     create_table_sql = """CREATE TABLE ProductCategory (
         ProductCategoryID INTEGER NOT NULL PRIMARY KEY,
         ProductCategory TEXT NOT NULL,
         ProductCategoryDescription TEXT NOT NULL );"""
-    insert_regions_sql = """INSERT INTO ProductCategory (ProductCategory, ProductCategoryDescription) VALUES ("{}", "{}");"""
-    data = pd.read_csv(data_filename, on_bad_lines="skip", header=0, sep="\t")
-    productcategory_description_combos = set()
-    for i in data.index:
-        product_categories = data["ProductCategory"][i].split(";")
-        product_category_descriptions = data["ProductCategoryDescription"][i].split(";")
-        for i in range(len(product_categories)):
-            productcategory_description_combos.add(
-                (product_categories[i], product_category_descriptions[i])
-            )
-    productcategory_description_combos = sorted(
-        list(productcategory_description_combos)
+    insert_regions_sql = """INSERT INTO ProductCategory (ProductCategoryID, ProductCategory, ProductCategoryDescription) VALUES (?, ?, ?);"""
+    productcategory_description_combos = list(
+        build_productcategory_dimension(order_lines).itertuples(index=False, name=None)
     )
     create_table(conn, create_table_sql, "ProductCategory")
- 
-    for (
-        product_category,
-        product_category_description,
-    ) in productcategory_description_combos:
-        sql_statement = insert_regions_sql.format(
-            product_category, product_category_description
+
+    execute_many_sql_statement(
+        insert_regions_sql,
+        [
+            (i, product_category, product_category_description)
+            for i, (product_category, product_category_description) in enumerate(
+                productcategory_description_combos, 1
+            )
+        ],
+        conn,
+    )
+    commit(conn)
+    return {
+        product_category: i
+        for i, (product_category, _) in enumerate(
+            productcategory_description_combos, 1
         )
-        execute_sql_statement(sql_statement, conn)
-    conn.commit()
+    }
+
+
+@instrumented
+def step7_create_productcategory_table(data_filename, normalized_database_filename):
+    # Inputs: Name of the data and normalized database filename
+    # Output: None
+
+    ### BEGIN SOLUTION
+    conn = create_connection(normalized_database_filename)
+    load_productcategory_table(conn, explode_order_lines(read_data(data_filename)))
     conn.close()
 
     ### END SOLUTION
 
 
+@instrumented
 def step8_create_productcategory_to_productcategoryid_dictionary(
     normalized_database_filename,
 ):
 
     ### BEGIN SOLUTION
     conn = create_connection(normalized_database_filename)
-    res = {}
-    df = pd.read_sql_query("select * from ProductCategory;", conn)
-    for i in df.index:
-        res[df["ProductCategory"][i]] = df["ProductCategoryID"][i]
+    res = dict(
+        execute_sql_statement(
+            "select ProductCategory, ProductCategoryID from ProductCategory;", conn
+        )
+    )
     conn.close()
     return res
 
     ### END SOLUTION
 
 
+def load_product_table(conn, order_lines, productcategory_to_productcategoryid_dict):
+    # Inputs: Open connection, the exploded order lines and the ProductCategory key map
+    # Output: Dictionary mapping each ProductName to the ProductID it was assigned
+
+    create_table_sql = """CREATE TABLE Product (
+        ProductID INTEGER NOT NULL PRIMARY KEY,
+        ProductName TEXT NOT NULL,
+        ProductUnitPrice REAL NOT NULL,
+        ProductCategoryID INTEGER NOT NULL,
+        FOREIGN KEY(ProductCategoryID) REFERENCES ProductCategory(ProductCategoryID) ON DELETE CASCADE ON UPDATE NO ACTION );"""
+    insert_regions_sql = """INSERT INTO Product (ProductID, ProductName, ProductUnitPrice, ProductCategoryID) VALUES (?, ?, ?, ?);"""
+    product_combos = list(
+        build_product_dimension(order_lines).itertuples(index=False, name=None)
+    )
+    create_table(conn, create_table_sql, "Product")
+    execute_many_sql_statement(
+        insert_regions_sql,
+        [
+            (
+                i,
+                name,
+                float(unit_price),
+                productcategory_to_productcategoryid_dict[category],
+            )
+            for i, (name, unit_price, category) in enumerate(product_combos, 1)
+        ],
+        conn,
+    )
+    commit(conn)
+    return {name: i for i, (name, _, _) in enumerate(product_combos, 1)}
+
+
+@instrumented
 def step9_create_product_table(data_filename, normalized_database_filename):
     # Inputs: Name of the data and normalized database filename
     # Output: None
@@ -263,67 +752,457 @@ def step9_create_product_table(data_filename, normalized_database_filename):
         )
     )
     conn = create_connection(normalized_database_filename)
-    create_table_sql = """CREATE TABLE Product (
-        ProductID INTEGER NOT NULL PRIMARY KEY,
-        ProductName TEXT NOT NULL,
-        ProductUnitPrice REAL NOT NULL,
-        ProductCategoryID INTEGER NOT NULL,
-        FOREIGN KEY(ProductCategoryID) REFERENCES ProductCategory(ProductCategoryID) ON DELETE CASCADE ON UPDATE NO ACTION );"""
-    insert_regions_sql = """INSERT INTO Product (ProductName, ProductUnitPrice, ProductCategoryID) VALUES ("{}", "{}", "{}");"""
-    data = pd.read_csv(data_filename, on_bad_lines="skip", header=0, sep="\t")
-    product_combos = set()
-    for i in data.index:
-        product_names = data["ProductName"][i].split(";")
-        product_unit_prices = data["ProductUnitPrice"][i].split(";")
-        product_categories = data["ProductCategory"][i].split(";")
-        for i in range(len(product_names)):
-            product_combos.add(
-                (product_names[i], product_unit_prices[i], product_categories[i])
-            )
-    product_combos = sorted(list(product_combos))
-    create_table(conn, create_table_sql, "Product")
-    for name, unit_price, category in product_combos:
-        sql_statement = insert_regions_sql.format(
-            name, unit_price, productcategory_to_productcategoryid_dict[category]
-        )
-        execute_sql_statement(sql_statement, conn)
-    conn.commit()
+    load_product_table(
+        conn,
+        explode_order_lines(read_data(data_filename)),
+        productcategory_to_productcategoryid_dict,
+    )
     conn.close()
 
     ### END SOLUTION
 
 
+@instrumented
 def step10_create_product_to_productid_dictionary(normalized_database_filename):
 
     ### BEGIN SOLUTION
     conn = create_connection(normalized_database_filename)
-    res = {}
-    df = pd.read_sql_query("select * from Product;", conn)
-    for i in df.index:
-        res[df["ProductName"][i]] = df["ProductID"][i]
+    res = dict(
+        execute_sql_statement("select ProductName, ProductID from Product;", conn)
+    )
     conn.close()
     return res
 
     ### END SOLUTION
 
 
-def step11_create_orderdetail_table(data_filename, normalized_database_filename):
-    # Inputs: Name of the data and normalized database filename
+def create_orderdetail_table(conn):
+    # Inputs: Open connection
     # Output: None
 
-    ### BEGIN SOLUTION
-
     create_table_sql = """CREATE TABLE IF NOT EXISTS [OrderDetail] (
             [OrderID] INTEGER NOT NULL PRIMARY KEY,
             [CustomerID] INTEGER NOT NULL,
             [ProductID] INTEGER NOT NULL,
             [OrderDate] INTEGER NOT NULL,
             [QuantityOrdered] INTEGER NOT NULL,
+            [DateKey] INTEGER NOT NULL,
             FOREIGN KEY(CustomerID) REFERENCES Customer(CustomerID) ON DELETE CASCADE ON UPDATE NO ACTION,
             FOREIGN KEY(ProductID) REFERENCES Product(ProductID) ON DELETE CASCADE ON UPDATE NO ACTION);"""
 
-    insert_regions_sql = """INSERT INTO OrderDetail (CustomerID, ProductID, OrderDate, QuantityOrdered) VALUES ({}, {}, '{}', {});"""
+    create_table(conn, create_table_sql, "OrderDetail")
+
+
+def resolve_keys(values, key_dictionary):
+    # Dictionary-encodes a column of natural keys, looks every distinct key up
+    # once and then gives each row its ID by integer code.
+    # Inputs: Series of natural keys (text or categorical) and the key map
+    # Output: Array with the ID of every value; raises KeyError if a value is
+    # missing or not in the key map
+
+    codes, keys = pd.factorize(values)
+    if (codes < 0).any():
+        raise KeyError("%d rows have no key" % (codes < 0).sum())
+    ids = pd.Series(keys).map(key_dictionary)
+    if ids.isna().any():
+        raise KeyError(
+            "no ID for %s" % ", ".join(map(repr, pd.Series(keys)[ids.isna()][:5]))
+        )
+    return ids.to_numpy()[codes]
+
+
+def parse_order_days(order_dates):
+    # Converts YYYYMMDD order dates to days since 1970-01-01. The dates are
+    # dictionary-encoded first, so every distinct date is parsed only once, by
+    # a single vectorized pd.to_datetime call.
+    # Inputs: Series (text or categorical) or array of YYYYMMDD strings
+    # Output: int32 array of day numbers; raises ValueError on an invalid date
+
+    codes, dates = pd.factorize(order_dates)
+    if (codes < 0).any():
+        raise ValueError("%d order lines have no order date" % (codes < 0).sum())
+    days = pd.to_datetime(np.asarray(dates, dtype=object), format="%Y%m%d")
+    if days.isna().any():  # pd.to_datetime parses a blank date as NaT
+        raise ValueError(
+            "invalid order date %s" % ", ".join(map(repr, dates[days.isna()][:5]))
+        )
+    return days.to_numpy(dtype="datetime64[D]").astype(np.int32)[codes]
+
+
+def stage_order_lines(
+    order_lines, customer_to_customerid_dictionary, product_to_product_id_dictionary
+):
+    # Resolves the exploded order lines into typed NumPy columns, 16 bytes per
+    # line, instead of one tuple of Python objects per line. OrderDay is the
+    # order date as days since 1970-01-01.
+    # Inputs: The exploded order lines and the Customer and Product key maps
+    # Output: Dict of CustomerID, ProductID, OrderDay and QuantityOrdered int32
+    # arrays. Lines whose customer or product has no ID raise KeyError before
+    # anything is cast, see resolve_keys.
+
+    return {
+        "CustomerID": resolve_keys(
+            order_lines["Name"], customer_to_customerid_dictionary
+        ).astype(np.int32),
+        "ProductID": resolve_keys(
+            order_lines["ProductName"], product_to_product_id_dictionary
+        ).astype(np.int32),
+        "OrderDay": parse_order_days(order_lines["OrderDate"]),
+        "QuantityOrdered": order_lines["QuantityOrdered"].to_numpy(dtype=np.int32),
+    }
+
+
+def order_line_columns(staged, start=0, end=None):
+    # Inputs: Staged order lines and the slice of them wanted
+    # Output: Dict of the CustomerID, ProductID, OrderDate ("YYYY-MM-DD"),
+    # QuantityOrdered and DateKey (YYYYMMDD) columns of OrderDetail
+
+    dates = staged["OrderDay"][start:end].astype("datetime64[D]")
+    months = dates.astype("datetime64[M]")
+    date_keys = (
+        (dates.astype("datetime64[Y]").astype(np.int64) + 1970) * 10000
+        + (months.astype(np.int64) % 12 + 1) * 100
+        + (dates - months).astype(np.int64)
+        + 1
+    )
+    return {
+        "CustomerID": staged["CustomerID"][start:end],
+        "ProductID": staged["ProductID"][start:end],
+        "OrderDate": np.datetime_as_string(dates, unit="D"),
+        "QuantityOrdered": staged["QuantityOrdered"][start:end],
+        "DateKey": date_keys,
+    }
+
+
+def order_line_rows(staged, batch_size=INSERT_BATCH_SIZE):
+    # Generator handing staged order lines to executemany. Only batch_size of
+    # them are turned into Python tuples at a time.
+    # Inputs: Staged order lines and the number of lines converted at a time
+    # Output: (CustomerID, ProductID, OrderDate, QuantityOrdered, DateKey)
+    # tuples
+
+    for start in range(0, len(staged["OrderDay"]), batch_size):
+        columns = order_line_columns(staged, start, start + batch_size)
+        yield from zip(*(column.tolist() for column in columns.values()))
+
+
+def resolve_order_lines(
+    order_lines, customer_to_customerid_dictionary, product_to_product_id_dictionary
+):
+    # Inputs: The exploded order lines and the Customer and Product key maps
+    # Output: DataFrame with the CustomerID, ProductID, OrderDate,
+    # QuantityOrdered and DateKey columns of OrderDetail
+
+    return pd.DataFrame(
+        order_line_columns(
+            stage_order_lines(
+                order_lines,
+                customer_to_customerid_dictionary,
+                product_to_product_id_dictionary,
+            )
+        )
+    )
+
+
+def insert_order_lines(
+    conn,
+    order_lines,
+    customer_to_customerid_dictionary,
+    product_to_product_id_dictionary,
+):
+    # Inputs: Open connection, the exploded order lines and the Customer and Product key maps
+    # Output: None
+
+    insert_regions_sql = """INSERT INTO OrderDetail (CustomerID, ProductID, OrderDate, QuantityOrdered, DateKey) VALUES (?, ?, ?, ?, ?);"""
+
+    staged = stage_order_lines(
+        order_lines, customer_to_customerid_dictionary, product_to_product_id_dictionary
+    )
+
+    execute_many_sql_statement(
+        insert_regions_sql,
+        order_line_rows(staged),
+        conn,
+        batch_size=INSERT_BATCH_SIZE,
+    )
+    commit(conn)
+
+
+def load_orderdetail_table(
+    conn,
+    order_lines,
+    customer_to_customerid_dictionary,
+    product_to_product_id_dictionary,
+):
+    # Inputs: Open connection, the exploded order lines and the Customer and Product key maps
+    # Output: None
+
+    create_orderdetail_table(conn)
+    insert_order_lines(
+        conn,
+        order_lines,
+        customer_to_customerid_dictionary,
+        product_to_product_id_dictionary,
+    )
+
+
+def stream_orderdetail_table(
+    conn,
+    data_filename,
+    customer_to_customerid_dictionary,
+    product_to_product_id_dictionary,
+    chunksize,
+):
+    # Reads the source chunksize rows at a time and inserts each chunk's order
+    # lines before reading the next, so only one chunk is ever held in memory.
+    # Inputs: Open connection, name of the data file, the Customer and Product
+    # key maps and the number of source rows per chunk
+    # Output: None
+
+    create_orderdetail_table(conn)
+    with read_data(data_filename, chunksize=chunksize) as chunks:
+        for chunk in chunks:
+            count_rows("rows_read", len(chunk))
+            insert_order_lines(
+                conn,
+                explode_order_lines(chunk),
+                customer_to_customerid_dictionary,
+                product_to_product_id_dictionary,
+            )
+
+
+def split_data_file(data_filename, parts):
+    # Inputs: Name of the data file and the number of ranges wanted
+    # Output: List of (start, end) byte offsets covering every line after the
+    # header, each range starting and ending on a line boundary
+    import os
+
+    size = os.path.getsize(data_filename)
+    with open(data_filename, "rb") as file:
+        file.readline()
+        bounds = [file.tell()]
+        for i in range(1, parts):
+            offset = bounds[0] + (size - bounds[0]) * i // parts
+            if offset <= bounds[-1]:
+                continue
+            file.seek(offset - 1)
+            file.readline()
+            bounds.append(file.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+_worker_customer_to_customerid_dictionary = None
+_worker_product_to_product_id_dictionary = None
+
+
+def _init_order_line_worker(
+    customer_to_customerid_dictionary, product_to_product_id_dictionary
+):
+    global _worker_customer_to_customerid_dictionary
+    global _worker_product_to_product_id_dictionary
+
+    _worker_customer_to_customerid_dictionary = customer_to_customerid_dictionary
+    _worker_product_to_product_id_dictionary = product_to_product_id_dictionary
+
+
+def parse_order_lines(data_filename, start, end):
+    # Runs in a worker process. Reads the lines between two byte offsets of the
+    # data file with read_data, so they are tokenized exactly like the rows the
+    # dimension tables were built from, and resolves the keys with the maps
+    # handed to _init_order_line_worker.
+    # Inputs: Name of the data file and the byte range to parse
+    # Output: Number of source rows parsed and their order lines staged as in
+    # stage_order_lines, so they are sent back as four compact arrays
+    import io
+
+    with open(data_filename, "rb") as file:
+        file.seek(start)
+        data = read_data(io.BytesIO(file.read(end - start)), header=None)
+    return len(data), stage_order_lines(
+        explode_order_lines(data, STAGED_ORDER_LINE_COLUMNS),
+        _worker_customer_to_customerid_dictionary,
+        _worker_product_to_product_id_dictionary,
+    )
+
+
+def parallel_orderdetail_table(
+    conn,
+    data_filename,
+    customer_to_customerid_dictionary,
+    product_to_product_id_dictionary,
+    processes,
+):
+    # Splits the source into byte ranges that are parsed by a pool of worker
+    # processes. This connection is the only writer; ranges are inserted in file
+    # order, so OrderIDs come out the same as with a sequential load.
+    # Inputs: Open connection, name of the data file, the Customer and Product
+    # key maps and the number of worker processes
+    # Output: None
+    from concurrent.futures import ProcessPoolExecutor
+
+    insert_regions_sql = """INSERT INTO OrderDetail (CustomerID, ProductID, OrderDate, QuantityOrdered, DateKey) VALUES (?, ?, ?, ?, ?);"""
+
+    create_orderdetail_table(conn)
+    ranges = split_data_file(data_filename, processes * 4)
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=_init_order_line_worker,
+        initargs=(customer_to_customerid_dictionary, product_to_product_id_dictionary),
+    ) as executor:
+        for rows, staged in executor.map(
+            parse_order_lines,
+            [data_filename] * len(ranges),
+            [start for start, _ in ranges],
+            [end for _, end in ranges],
+        ):
+            count_rows("rows_read", rows)
+            execute_many_sql_statement(
+                insert_regions_sql, order_line_rows(staged), conn
+            )
+            commit(conn)
+
+
+REPORT_INDEXES = [
+    # Covers the per-customer sales totals of ex1-ex9 and the per-customer
+    # order date walk of ex11 without touching the OrderDetail rows.
+    "CREATE INDEX IF NOT EXISTS OrderDetail_CustomerID ON OrderDetail (CustomerID, OrderDate, DateKey, ProductID, QuantityOrdered);",
+    "CREATE INDEX IF NOT EXISTS OrderDetail_ProductID ON OrderDetail (ProductID);",
+    "CREATE INDEX IF NOT EXISTS OrderDetail_DateKey ON OrderDetail (DateKey, ProductID, QuantityOrdered);",
+    "CREATE INDEX IF NOT EXISTS Country_RegionID ON Country (RegionID);",
+    "CREATE INDEX IF NOT EXISTS Customer_CountryID ON Customer (CountryID);",
+    # Name lookups of ex1 and ex2, see lookup_customer_ids.
+    "CREATE INDEX IF NOT EXISTS Customer_FirstName_LastName ON Customer (FirstName, LastName);",
+]
+
+
+def create_report_indexes(conn):
+    # Creates the secondary indexes used by the ex report queries and refreshes
+    # the planner statistics. Run it after the tables are loaded, building the
+    # indexes once is much cheaper than maintaining them on every insert.
+    # Inputs: Open connection
+    # Output: None
+
+    for sql_statement in REPORT_INDEXES:
+        execute_sql_statement(sql_statement, conn)
+    execute_sql_statement("ANALYZE;", conn)
+    commit(conn)
+
+
+def refresh_date_table(conn):
+    # Fills the Date dimension with every day from the first to the last
+    # OrderDetail.DateKey, so the time reports group by its integer columns
+    # instead of parsing OrderDate with strftime on every row. Days already in
+    # the table are kept.
+    # Inputs: Open connection
+    # Output: None
+
+    create_table_sql = """CREATE TABLE IF NOT EXISTS Date (
+        DateKey INTEGER NOT NULL PRIMARY KEY,
+        Year INTEGER NOT NULL,
+        Quarter INTEGER NOT NULL,
+        Month INTEGER NOT NULL,
+        MonthName TEXT NOT NULL );"""
+    insert_date_sql = """INSERT INTO Date (DateKey, Year, Quarter, Month, MonthName) VALUES (?, ?, ?, ?, ?) ON CONFLICT (DateKey) DO NOTHING;"""
+
+    create_table(conn, create_table_sql)
+    first_date_key, last_date_key = execute_sql_statement(
+        "select min(DateKey), max(DateKey) from OrderDetail;", conn
+    )[0]
+    if first_date_key is None:
+        return
+
+    days = pd.date_range(str(first_date_key), str(last_date_key))
+    execute_many_sql_statement(
+        insert_date_sql,
+        zip(
+            (days.year * 10000 + days.month * 100 + days.day).tolist(),
+            days.year.tolist(),
+            days.quarter.tolist(),
+            days.month.tolist(),
+            days.month_name().tolist(),
+        ),
+        conn,
+    )
+    commit(conn)
+
+
+SALES_SUMMARIES = {
+    "CustomerSales": """
+    SELECT CustomerID, SUM(LineTotal) as Total FROM OrderDetail
+    GROUP BY CustomerID;""",
+    "CountrySales": """
+    SELECT Customer.CountryID, SUM(OrderDetail.LineTotal) as Total FROM OrderDetail
+    JOIN Customer ON OrderDetail.CustomerID = Customer.CustomerID
+    GROUP BY Customer.CountryID;""",
+    "RegionSales": """
+    SELECT Country.RegionID, SUM(OrderDetail.LineTotal) as Total FROM OrderDetail
+    JOIN Customer ON OrderDetail.CustomerID = Customer.CustomerID
+    JOIN Country ON Customer.CountryID = Country.CountryID
+    GROUP BY Country.RegionID;""",
+    "QuarterlySales": """
+    SELECT 'Q' || Date.Quarter as Quarter, Date.Year, OrderDetail.CustomerID, SUM(OrderDetail.LineTotal) as Total FROM OrderDetail
+    JOIN Date ON OrderDetail.DateKey = Date.DateKey
+    GROUP BY Date.Year, Date.Quarter, OrderDetail.CustomerID;""",
+    "MonthlySales": """
+    SELECT Date.MonthName as Month, SUM(ROUND(OrderDetail.LineTotal)) as Total FROM OrderDetail
+    JOIN Date ON OrderDetail.DateKey = Date.DateKey
+    GROUP BY Date.Month;""",
+}
+
+
+def drop_sales_summaries(conn):
+    # Inputs: Open connection
+    # Output: None
+
+    for table_name in SALES_SUMMARIES:
+        execute_sql_statement("DROP TABLE IF EXISTS %s;" % table_name, conn)
+    commit(conn)
+
+
+def refresh_sales_summaries(conn):
+    # Materializes OrderDetail.LineTotal (QuantityOrdered * ProductUnitPrice) for
+    # the lines that do not have it yet and rebuilds the SALES_SUMMARIES tables
+    # from it. ex3-ex10 read these tables instead of re-joining OrderDetail with
+    # Product whenever they exist.
+    # Inputs: Open connection
+    # Output: None
+
+    columns = execute_sql_statement("PRAGMA table_info(OrderDetail);", conn)
+    if "LineTotal" not in [column[1] for column in columns]:
+        execute_sql_statement(
+            "ALTER TABLE OrderDetail ADD COLUMN LineTotal REAL;", conn
+        )
+    execute_sql_statement(
+        """UPDATE OrderDetail SET LineTotal = QuantityOrdered * (
+            SELECT ProductUnitPrice FROM Product
+            WHERE Product.ProductID = OrderDetail.ProductID)
+        WHERE LineTotal IS NULL;""",
+        conn,
+    )
+    for table_name, select_sql in SALES_SUMMARIES.items():
+        execute_sql_statement("DROP TABLE IF EXISTS %s;" % table_name, conn)
+        execute_sql_statement("CREATE TABLE %s AS %s" % (table_name, select_sql), conn)
+    commit(conn)
+
 
+@instrumented
+def step11_create_orderdetail_table(
+    data_filename,
+    normalized_database_filename,
+    chunksize=None,
+    processes=None,
+    create_indexes=True,
+    materialize_summaries=False,
+):
+    # Inputs: Name of the data and normalized database filename. Passing
+    # chunksize streams the source in chunks of that many rows; passing
+    # processes parses it with that many worker processes instead.
+    # create_indexes=False skips building the report indexes afterwards and
+    # materialize_summaries=True builds the sales summary tables.
+    # Output: None
+
+    ### BEGIN SOLUTION
     customer_to_customerid_dictionary = step6_create_customer_to_customerid_dictionary(
         normalized_database_filename
     )
@@ -331,49 +1210,545 @@ def step11_create_orderdetail_table(data_filename, normalized_database_filename)
         normalized_database_filename
     )
 
-    header = None
-    orders = []
-
     conn = create_connection(normalized_database_filename)
+    try:
+        with build_mode(conn):
+            if processes:
+                parallel_orderdetail_table(
+                    conn,
+                    data_filename,
+                    customer_to_customerid_dictionary,
+                    product_to_product_id_dictionary,
+                    processes,
+                )
+            elif chunksize:
+                stream_orderdetail_table(
+                    conn,
+                    data_filename,
+                    customer_to_customerid_dictionary,
+                    product_to_product_id_dictionary,
+                    chunksize,
+                )
+            else:
+                load_orderdetail_table(
+                    conn,
+                    explode_order_lines(read_data(data_filename)),
+                    customer_to_customerid_dictionary,
+                    product_to_product_id_dictionary,
+                )
+            refresh_date_table(conn)
+            if create_indexes:
+                create_report_indexes(conn)
+            if materialize_summaries:
+                refresh_sales_summaries(conn)
+            else:
+                drop_sales_summaries(conn)
+            bump_load_generation(conn)
+    finally:
+        conn.close()
+    ### END SOLUTION
 
-    with open(data_filename, "r") as file:
-        for line in file:
-            if not header:
-                header = line.strip().split("\t")
-                continue
 
-            cust_name = line.strip().split("\t")[0]
-            cust_id = customer_to_customerid_dictionary[cust_name]
-            prod_name = line.strip().split("\t")[5].split(";")
-            prod_id = [product_to_product_id_dictionary[prod] for prod in prod_name]
-            order_date = line.strip().split("\t")[10].split(";")
-            quantity = line.strip().split("\t")[9].split(";")
+def drop_all_tables(conn):
+    # Empties the database for a full rebuild. The file itself is kept, unlike
+    # create_connection(delete_db=True), so its load generation survives and
+    # open readers switch to the new data instead of holding on to a deleted
+    # file. Foreign keys are off while dropping so nothing cascades.
+    # Inputs: Open connection
+    # Output: None
+
+    commit(conn)
+    foreign_keys = execute_sql_statement("PRAGMA foreign_keys;", conn)[0][0]
+    execute_sql_statement("PRAGMA foreign_keys = 0;", conn)
+    tables = execute_sql_statement(
+        "select name from sqlite_master where type = 'table' "
+        "and name not like 'sqlite_%';",
+        conn,
+    )
+    for (table_name,) in tables:
+        execute_sql_statement("DROP TABLE [%s];" % table_name, conn)
+    commit(conn)
+    execute_sql_statement("PRAGMA foreign_keys = %d;" % foreign_keys, conn)
+
+
+def bump_load_generation(conn):
+    # Every completed load increments the database's user_version, so report
+    # caches can tell that their results are stale with one cheap PRAGMA.
+    # Inputs: Open connection
+    # Output: The new load generation
+
+    generation = execute_sql_statement("PRAGMA user_version;", conn)[0][0] + 1
+    execute_sql_statement("PRAGMA user_version = %d;" % generation, conn)
+    commit(conn)
+    return generation
+
+
+def create_build_connection(normalized_database_filename):
+    # Inputs: Normalized database filename the build will be persisted to
+    # Output: Connection to an empty in-memory database using the target's page
+    # size, which the backup API requires when the target is in WAL mode
+
+    target_conn = create_connection(normalized_database_filename)
+    page_size = execute_sql_statement("PRAGMA page_size;", target_conn)[0][0]
+    target_conn.close()
+    conn = create_connection(":memory:")
+    execute_sql_statement("PRAGMA page_size = %d;" % page_size, conn)
+    return conn
+
+
+def persist_database(conn, normalized_database_filename):
+    # Copies a finished in-memory build over the normalized database with the
+    # backup API. The copy is a single write transaction on the target, so
+    # readers see either the previous database or the complete new one. The
+    # load generation continues from the target's.
+    # Inputs: Connection to the in-memory build and normalized database filename
+    # Output: None
+
+    target_conn = create_connection(normalized_database_filename)
+    generation = execute_sql_statement("PRAGMA user_version;", target_conn)[0][0]
+    execute_sql_statement("PRAGMA user_version = %d;" % generation, conn)
+    bump_load_generation(conn)
+    conn.backup(target_conn)
+    target_conn.close()
+
+
+@instrumented
+def normalize(
+    data_filename,
+    normalized_database_filename,
+    chunksize=None,
+    processes=None,
+    create_indexes=True,
+    materialize_summaries=False,
+    in_memory=False,
+):
+    # Builds every table of the normalized database from a single read of the source.
+    # With chunksize the source is streamed instead: one pass collects the distinct
+    # dimension rows and a second pass loads OrderDetail chunk by chunk. With
+    # processes the dimensions are collected the same way and the second pass
+    # is parsed by a pool of worker processes. With in_memory the database is
+    # built in memory and then copied to the file in one step, so the file is
+    # never half built (the whole database must fit in memory).
+    # Inputs: Name of the data and normalized database filename, optional chunk
+    # size and number of worker processes, whether to build the report indexes
+    # and the sales summary tables, and whether to build in memory
+    # Output: None
+
+    if chunksize or processes:
+        data, order_lines = read_dimension_data(
+            data_filename, chunksize or DIMENSION_CHUNK_SIZE
+        )
+    else:
+        data = read_data(data_filename)
+        order_lines = explode_order_lines(data)
+    if in_memory:
+        conn = create_build_connection(normalized_database_filename)
+    else:
+        conn = create_connection(normalized_database_filename)
+    try:
+        with build_mode(conn):
+            if not in_memory:
+                drop_all_tables(conn)
+
+            region_to_regionid_dict = load_region_table(conn, data)
+            country_to_countryid_dict = load_country_table(
+                conn, data, region_to_regionid_dict
+            )
+            customer_to_customerid_dict = load_customer_table(
+                conn, data, country_to_countryid_dict
+            )
+            productcategory_to_productcategoryid_dict = load_productcategory_table(
+                conn, order_lines
+            )
+            product_to_productid_dict = load_product_table(
+                conn, order_lines, productcategory_to_productcategoryid_dict
+            )
+            if processes:
+                parallel_orderdetail_table(
+                    conn,
+                    data_filename,
+                    customer_to_customerid_dict,
+                    product_to_productid_dict,
+                    processes,
+                )
+            elif chunksize:
+                stream_orderdetail_table(
+                    conn,
+                    data_filename,
+                    customer_to_customerid_dict,
+                    product_to_productid_dict,
+                    chunksize,
+                )
+            else:
+                load_orderdetail_table(
+                    conn,
+                    order_lines,
+                    customer_to_customerid_dict,
+                    product_to_productid_dict,
+                )
+            refresh_date_table(conn)
+            if create_indexes:
+                create_report_indexes(conn)
+            if materialize_summaries:
+                refresh_sales_summaries(conn)
+            if not in_memory:
+                bump_load_generation(conn)
+        if in_memory:
+            persist_database(conn, normalized_database_filename)
+    finally:
+        conn.close()
+
+
+def insert_new_rows(conn, table_name, columns, rows):
+    # Adds the rows whose columns are not in the table yet. The columns are
+    # the key the full build deduplicates the dimension on, so rows that
+    # normalize kept apart (two customers with the same name at different
+    # addresses) are matched apart here too.
+    # Inputs: Open connection, table name, the column names and the rows as
+    # tuples in column order
+    # Output: None
 
-            quantity = [int(q) for q in quantity]
+    rows = pd.DataFrame.from_records(list(rows), columns=columns)
+    if rows.empty:
+        return
+    loaded = pd.read_sql_query(
+        "select %s from [%s];" % (", ".join(columns), table_name), conn
+    ).drop_duplicates()
+    rows = rows.merge(loaded, on=columns, how="left", indicator=True)
+    execute_many_sql_statement(
+        "INSERT INTO [%s] (%s) VALUES (%s);"
+        % (table_name, ", ".join(columns), ", ".join(["?"] * len(columns))),
+        rows.loc[rows["_merge"] == "left_only", columns].itertuples(
+            index=False, name=None
+        ),
+        conn,
+    )
+
+
+def remove_loaded_orders(conn, orders):
+    # Inputs: Open connection and the resolved OrderDetail rows of a delta
+    # Output: The rows of orders that are not in OrderDetail yet. Identical
+    # lines are matched one for one, so a delta that is loaded twice adds
+    # nothing the second time while repeated lines within a delta are kept.
+
+    key = ["CustomerID", "ProductID", "OrderDate", "QuantityOrdered"]
+    if orders.empty:
+        return orders[key + ["DateKey"]]
+    loaded = pd.read_sql_query(
+        "select CustomerID, ProductID, OrderDate, QuantityOrdered from OrderDetail "
+        "where DateKey >= ? and DateKey <= ?;",
+        conn,
+        params=(int(orders["DateKey"].min()), int(orders["DateKey"].max())),
+    )
+    loaded["Occurrence"] = loaded.groupby(key).cumcount()
+    orders = orders.assign(Occurrence=orders.groupby(key).cumcount())
+    orders = orders.merge(
+        loaded, on=key + ["Occurrence"], how="left", indicator=True
+    )
+    return orders.loc[orders["_merge"] == "left_only", key + ["DateKey"]]
+
+
+@instrumented
+def append_data(data_filename, normalized_database_filename, create_indexes=True):
+    # Loads a delta file into an existing normalized database. Regions,
+    # countries, customers, product categories and products that are already
+    # present keep their IDs and new ones are added after them; only order
+    # lines that are not loaded yet are appended to OrderDetail. The new rows,
+    # the Date, index and sales summary refreshes and the load generation are
+    # committed as one transaction, with the database's own journal kept so a
+    # crash cannot damage the rows loaded before. A database without tables
+    # gets a full build instead and a delta without rows changes nothing.
+    # Sales summary tables are refreshed if the database has them.
+    # Inputs: Name of the delta data file and normalized database filename, and
+    # whether to build the report indexes and refresh their statistics
+    # Output: None
 
-            order_date = [
-                datetime.datetime.strptime(date, "%Y%m%d").strftime("%Y-%m-%d")
-                for date in order_date
-            ]
+    conn = create_connection(normalized_database_filename)
+    if not table_exists(conn, "OrderDetail"):
+        conn.close()
+        normalize(
+            data_filename, normalized_database_filename, create_indexes=create_indexes
+        )
+        return
 
-            temp_cust_id = [cust_id] * len(prod_id)
-            orders.extend((list(zip(temp_cust_id, prod_id, order_date, quantity))))
+    try:
+        data = read_data(data_filename)
+        if data.empty:
+            return
+        order_lines = explode_order_lines(data)
+
+        with build_mode(conn, durable=True):
+            insert_new_rows(
+                conn,
+                "Region",
+                ["Region"],
+                build_region_dimension(data).itertuples(index=False, name=None),
+            )
+            region_to_regionid_dict = dict(
+                execute_sql_statement("select Region, RegionID from Region;", conn)
+            )
 
-        create_table(conn, create_table_sql, "OrderDetail")
+            insert_new_rows(
+                conn,
+                "Country",
+                ["Country", "RegionID"],
+                [
+                    (country, region_to_regionid_dict[region])
+                    for country, region in build_country_dimension(data).itertuples(
+                        index=False, name=None
+                    )
+                ],
+            )
+            country_to_countryid_dict = dict(
+                execute_sql_statement("select Country, CountryID from Country;", conn)
+            )
 
-        for cust_id, prod_id, order_date, quantity in orders:
-            sql_statement = insert_regions_sql.format(
-                cust_id, prod_id, order_date, quantity
+            insert_new_rows(
+                conn,
+                "Customer",
+                ["FirstName", "LastName", "Address", "City", "CountryID"],
+                [
+                    (
+                        first_name,
+                        last_name,
+                        address,
+                        city,
+                        country_to_countryid_dict[country],
+                    )
+                    for first_name, last_name, address, city, country in (
+                        build_customer_dimension(data).itertuples(
+                            index=False, name=None
+                        )
+                    )
+                ],
+            )
+            customer_to_customerid_dict = dict(
+                execute_sql_statement(
+                    "select FirstName || ' ' || LastName, CustomerID from Customer;",
+                    conn,
+                )
             )
 
-            execute_sql_statement(sql_statement, conn)
+            insert_new_rows(
+                conn,
+                "ProductCategory",
+                ["ProductCategory", "ProductCategoryDescription"],
+                build_productcategory_dimension(order_lines).itertuples(
+                    index=False, name=None
+                ),
+            )
+            productcategory_to_productcategoryid_dict = dict(
+                execute_sql_statement(
+                    "select ProductCategory, ProductCategoryID from ProductCategory;",
+                    conn,
+                )
+            )
 
-    conn.commit()
-    conn.close()
-    ### END SOLUTION
+            insert_new_rows(
+                conn,
+                "Product",
+                ["ProductName", "ProductUnitPrice", "ProductCategoryID"],
+                [
+                    (
+                        name,
+                        float(unit_price),
+                        productcategory_to_productcategoryid_dict[category],
+                    )
+                    for name, unit_price, category in (
+                        build_product_dimension(order_lines).itertuples(
+                            index=False, name=None
+                        )
+                    )
+                ],
+            )
+            product_to_productid_dict = dict(
+                execute_sql_statement(
+                    "select ProductName, ProductID from Product;", conn
+                )
+            )
+
+            orders = remove_loaded_orders(
+                conn,
+                resolve_order_lines(
+                    order_lines, customer_to_customerid_dict, product_to_productid_dict
+                ),
+            )
+            execute_many_sql_statement(
+                "INSERT INTO OrderDetail "
+                "(CustomerID, ProductID, OrderDate, QuantityOrdered, DateKey) "
+                "VALUES (?, ?, ?, ?, ?);",
+                orders.itertuples(index=False, name=None),
+                conn,
+            )
+            refresh_date_table(conn)
+            if create_indexes:
+                create_report_indexes(conn)
+            if table_exists(conn, "CustomerSales"):
+                refresh_sales_summaries(conn)
+            bump_load_generation(conn)
+    finally:
+        conn.close()
+
+
+EXPORT_TABLES = [
+    "Region",
+    "Country",
+    "Customer",
+    "ProductCategory",
+    "Product",
+    "OrderDetail",
+]
+
+EXPORT_CHUNK_SIZE = 100000
+
+
+def to_arrow_table(chunk, dictionaries, schema=None):
+    # Converts a chunk of a table to Arrow. Text columns become dictionary
+    # arrays whose dictionary only grows from chunk to chunk, so every chunk's
+    # dictionary extends the previous one, which Arrow IPC files require.
+    # Inputs: DataFrame chunk, dict of text column name to the pd.Index of its
+    # values so far (updated in place) and the schema of the first chunk
+    # Output: pyarrow Table
+    import pyarrow as pa
+
+    arrays = []
+    for name in chunk.columns:
+        values = chunk[name]
+        if name in dictionaries:
+            dictionary = dictionaries[name]
+            new_values = pd.Index(values.dropna().unique()).difference(
+                dictionary, sort=False
+            )
+            if len(new_values):
+                dictionary = dictionaries[name] = dictionary.append(new_values)
+            codes = dictionary.get_indexer(values)
+            arrays.append(
+                pa.DictionaryArray.from_arrays(
+                    pa.array(codes, type=pa.int32(), mask=codes < 0),
+                    pa.array(dictionary, type=pa.string()),
+                )
+            )
+        elif schema is None:
+            arrays.append(pa.array(values))
+        else:
+            arrays.append(pa.array(values, type=schema.field(name).type))
+    if schema is None:
+        return pa.Table.from_arrays(arrays, names=list(chunk.columns))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def export_table(conn, table_name, filename, file_format, chunksize):
+    # Streams one table into a Parquet or Arrow IPC file, see export_tables. The
+    # writer is closed either way and a file left half written by an error is
+    # removed.
+    # Inputs: Open connection, table name, output filename, "parquet" or
+    # "feather" and rows per chunk
+    # Output: True if the table had rows and the file was written
+    import os
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sql_statement = "SELECT * FROM [%s];" % table_name
+    writer = None
+    try:
+        try:
+            dictionaries = {}
+            chunks = pd.read_sql_query(sql_statement, conn, chunksize=chunksize)
+            for chunk in chunks:
+                if writer is None:
+                    dictionaries = {
+                        name: pd.Index([], dtype=object)
+                        for name in chunk.columns
+                        if pd.api.types.is_string_dtype(chunk[name])
+                    }
+                    table = to_arrow_table(chunk, dictionaries)
+                    if file_format == "parquet":
+                        writer = pq.ParquetWriter(filename, table.schema)
+                    else:
+                        writer = pa.ipc.new_file(
+                            filename,
+                            table.schema,
+                            options=pa.ipc.IpcWriteOptions(
+                                emit_dictionary_deltas=True
+                            ),
+                        )
+                else:
+                    table = to_arrow_table(chunk, dictionaries, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    except BaseException:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    return writer is not None
+
+
+def export_tables(
+    normalized_database_filename,
+    export_dir,
+    file_format="parquet",
+    chunksize=EXPORT_CHUNK_SIZE,
+    tables=EXPORT_TABLES,
+):
+    # Writes every table to its own columnar file, <export_dir>/<table>.parquet
+    # or <table>.feather. Tables are streamed chunksize rows at a time, one
+    # Parquet row group or Arrow record batch per chunk, so memory is bounded by
+    # the chunk size. Text columns are dictionary encoded. Needs pyarrow.
+    # Inputs: Normalized database filename, output directory, "parquet" or
+    # "feather", rows per chunk and the tables to export
+    # Output: Dict of table name to the file written
+    import os
+
+    if file_format not in ("parquet", "feather"):
+        raise ValueError("file_format must be 'parquet' or 'feather'")
+    os.makedirs(export_dir, exist_ok=True)
+
+    conn = create_connection(normalized_database_filename)
+    files = {}
+    try:
+        for table_name in tables:
+            filename = os.path.join(export_dir, "%s.%s" % (table_name, file_format))
+            if export_table(conn, table_name, filename, file_format, chunksize):
+                files[table_name] = filename
+    finally:
+        conn.close()
+    return files
+
+
+def table_exists(conn, table_name):
+    # Inputs: Open connection and a table name
+    # Output: True when the database has a table with that name
+
+    return bool(
+        execute_sql_statement(
+            "select 1 from sqlite_master where type = 'table' and name = ?;",
+            conn,
+            (table_name,),
+        )
+    )
+
+
+def lookup_customer_ids(conn, CustomerName):
+    # Resolves a "FirstName LastName" name with bound parameters against the
+    # (FirstName, LastName) index instead of comparing the concatenated name of
+    # every customer. The FirstName is the first word of the name, as loaded.
+    # Inputs: Open connection and the customer name
+    # Output: Comma-separated CustomerIDs for an IN (...) list, "NULL" when no
+    # customer has that name
+
+    first_name, _, last_name = CustomerName.partition(" ")
+    rows = execute_sql_statement(
+        "select CustomerID from Customer where FirstName = ? and LastName = ?;",
+        conn,
+        (first_name, last_name),
+    )
+    return ", ".join(str(row[0]) for row in rows) or "NULL"
 
 
-def ex1(conn, CustomerName):
+@instrumented
+def ex1(conn, CustomerName, execute=True):
 
     # Simply, you are fetching all the rows for a given CustomerName.
     # Write an SQL statement that SELECTs From the OrderDetail table and joins with the Customer and Product table.
@@ -390,19 +1765,22 @@ def ex1(conn, CustomerName):
 
     sql_statement = """
     SELECT Customer.FirstName || ' ' || Customer.LastName as Name, Product.ProductName, OrderDetail.OrderDate, Product.ProductUnitPrice,OrderDetail.QuantityOrdered, ROUND(OrderDetail.QuantityOrdered * Product.ProductUnitPrice, 2) as Total
-    FROM Customer
-    JOIN OrderDetail ON Customer.CustomerID = OrderDetail.CustomerID
+    FROM OrderDetail
+    JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID
     JOIN Product ON OrderDetail.ProductID = Product.ProductID
-    WHERE Customer.FirstName || ' ' || Customer.LastName = '{}';
+    WHERE OrderDetail.CustomerID IN ({})
+    ORDER BY OrderDetail.OrderID;
     """.format(
-        CustomerName
+        lookup_customer_ids(conn, CustomerName)
     )
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex2(conn, CustomerName):
+@instrumented
+def ex2(conn, CustomerName, execute=True):
 
     # Simply, you are summing the total for a given CustomerName.
     # Write an SQL statement that SELECTs From the OrderDetail table and joins with the Customer and Product table.
@@ -414,20 +1792,22 @@ def ex2(conn, CustomerName):
     ### BEGIN SOLUTION
     sql_statement = """
     SELECT DISTINCT Customer.FirstName || ' ' || Customer.LastName as Name, ROUND(SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice), 2) as Total
-    FROM Customer
-    JOIN OrderDetail ON Customer.CustomerID = OrderDetail.CustomerID
+    FROM OrderDetail
+    JOIN Customer ON Customer.CustomerID = OrderDetail.CustomerID
     JOIN Product ON OrderDetail.ProductID = Product.ProductID
-    WHERE Customer.FirstName || ' ' || Customer.LastName = '{}'
+    WHERE OrderDetail.CustomerID IN ({})
     GROUP BY Customer.CustomerID;
     """.format(
-        CustomerName
+        lookup_customer_ids(conn, CustomerName)
     )
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex3(conn):
+@instrumented
+def ex3(conn, execute=True):
 
     # Simply, find the total for all the customers
     # Write an SQL statement that SELECTs From the OrderDetail table and joins with the Customer and Product table.
@@ -436,7 +1816,15 @@ def ex3(conn):
     # Total -- which is calculated from multiplying ProductUnitPrice with QuantityOrdered -- sum first and then round to two decimal places
     # ORDER BY Total Descending
     ### BEGIN SOLUTION
-    sql_statement = """
+    if table_exists(conn, "CustomerSales"):
+        sql_statement = """
+    SELECT DISTINCT Customer.FirstName || ' ' || Customer.LastName as Name, ROUND(CustomerSales.Total, 2) as Total
+    FROM CustomerSales
+    JOIN Customer ON Customer.CustomerID = CustomerSales.CustomerID
+    ORDER BY Total DESC;
+    """
+    else:
+        sql_statement = """
     SELECT DISTINCT Customer.FirstName || ' ' || Customer.LastName as Name, ROUND(SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice), 2) as Total
     FROM Customer
     JOIN OrderDetail ON Customer.CustomerID = OrderDetail.CustomerID
@@ -445,11 +1833,13 @@ def ex3(conn):
     ORDER BY Total DESC;
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex4(conn):
+@instrumented
+def ex4(conn, execute=True):
 
     # Simply, find the total for all the region
     # Write an SQL statement that SELECTs From the OrderDetail table and joins with the Customer, Product, Country, and
@@ -460,7 +1850,16 @@ def ex4(conn):
     # ORDER BY Total Descending
     ### BEGIN SOLUTION
 
-    sql_statement = """
+    if table_exists(conn, "RegionSales"):
+        sql_statement = """
+    SELECT Region.Region, ROUND(SUM(RegionSales.Total), 2) as Total
+    FROM RegionSales
+    JOIN Region ON RegionSales.RegionID = Region.RegionID
+    GROUP BY Region.Region
+    ORDER BY Total DESC;
+    """
+    else:
+        sql_statement = """
     SELECT Region.Region, ROUND(SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice), 2) as Total
     FROM Customer
     JOIN OrderDetail ON Customer.CustomerID = OrderDetail.CustomerID
@@ -471,11 +1870,13 @@ def ex4(conn):
     ORDER BY Total DESC;
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex5(conn):
+@instrumented
+def ex5(conn, execute=True):
 
     # Simply, find the total for all the countries
     # Write an SQL statement that SELECTs From the OrderDetail table and joins with the Customer, Product, and Country table.
@@ -485,7 +1886,16 @@ def ex5(conn):
     # ORDER BY Total Descending
     ### BEGIN SOLUTION
 
-    sql_statement = """
+    if table_exists(conn, "CountrySales"):
+        sql_statement = """
+    SELECT Country.Country, ROUND(SUM(CountrySales.Total), 0) as CountryTotal
+    FROM CountrySales
+    JOIN Country ON CountrySales.CountryID = Country.CountryID
+    GROUP BY Country.Country
+    ORDER BY CountryTotal DESC;
+    """
+    else:
+        sql_statement = """
     SELECT Country.Country, ROUND(SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice), 0) as CountryTotal
     FROM Customer
     JOIN OrderDetail ON Customer.CustomerID = OrderDetail.CustomerID
@@ -495,18 +1905,30 @@ def ex5(conn):
     ORDER BY CountryTotal DESC;
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex6(conn):
+@instrumented
+def ex6(conn, execute=True):
 
     # Rank the countries within a region based on order total
     # Output Columns: Region, Country, CountryTotal, CountryRegionalRank
     # Hint: Round the the total
     # Hint: Sort ASC by Region
     ### BEGIN SOLUTION
-    sql_statement = """
+    if table_exists(conn, "CountrySales"):
+        sql_statement = """
+    SELECT Region.Region, Country.Country, ROUND(SUM(CountrySales.Total), 0) as CountryTotal, Rank() OVER (PARTITION BY Region.Region ORDER BY SUM(CountrySales.Total) DESC) as CountryRegionalRank
+    FROM CountrySales
+    JOIN Country ON CountrySales.CountryID = Country.CountryID
+    JOIN Region ON Country.RegionID = Region.RegionID
+    GROUP BY Region.Region, Country.Country
+    ORDER BY Region.Region;
+    """
+    else:
+        sql_statement = """
     SELECT Region.Region, Country.Country, ROUND(SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice), 0) as CountryTotal, Rank() OVER (PARTITION BY Region.Region ORDER BY SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice) DESC) as CountryRegionalRank
     FROM Customer
     JOIN OrderDetail ON Customer.CustomerID = OrderDetail.CustomerID
@@ -518,11 +1940,13 @@ def ex6(conn):
     """
 
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex7(conn):
+@instrumented
+def ex7(conn, execute=True):
 
     # Rank the countries within a region based on order total, BUT only select the TOP country, meaning rank = 1!
     # Output Columns: Region, Country, CountryTotal, CountryRegionalRank
@@ -531,7 +1955,17 @@ def ex7(conn):
     # HINT: Use "WITH"
     ### BEGIN SOLUTION
 
-    sql_statement = """
+    if table_exists(conn, "CountrySales"):
+        sql_statement = """
+    SELECT * FROM ( SELECT Region.Region, Country.Country, ROUND(SUM(CountrySales.Total), 0) as CountryTotal, Rank() OVER (PARTITION BY Region.Region ORDER BY SUM(CountrySales.Total) DESC) as CountryRegionalRank
+    FROM CountrySales
+    JOIN Country ON CountrySales.CountryID = Country.CountryID
+    JOIN Region ON Country.RegionID = Region.RegionID
+    GROUP BY Region.Region, Country.Country) WHERE CountryRegionalRank = 1
+    ORDER BY Region;
+    """
+    else:
+        sql_statement = """
     SELECT * FROM ( SELECT Region.Region, Country.Country, ROUND(SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice), 0) as CountryTotal, Rank() OVER (PARTITION BY Region.Region ORDER BY SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice) DESC) as CountryRegionalRank
     FROM Customer
     JOIN OrderDetail ON Customer.CustomerID = OrderDetail.CustomerID
@@ -542,11 +1976,13 @@ def ex7(conn):
     ORDER BY Region;
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex8(conn):
+@instrumented
+def ex8(conn, execute=True):
 
     # Sum customer sales by Quarter and year
     # Output Columns: Quarter,Year,CustomerID,Total
@@ -555,7 +1991,21 @@ def ex8(conn):
     # HINT: YOU MUST CAST YEAR TO TYPE INTEGER!!!!
     ### BEGIN SOLUTION
 
-    sql_statement = """
+    if table_exists(conn, "QuarterlySales"):
+        sql_statement = """
+      SELECT Quarter, Year, CustomerID, ROUND(Total, 0) as Total FROM QuarterlySales
+      ORDER BY Year, Quarter;
+    """
+    elif table_exists(conn, "Date"):
+        sql_statement = """
+      SELECT 'Q' || Date.Quarter as Quarter, Date.Year, OrderDetail.CustomerID, ROUND(SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice), 0) as Total FROM OrderDetail
+      JOIN Date ON OrderDetail.DateKey = Date.DateKey
+      JOIN Product ON OrderDetail.ProductID = Product.ProductID
+      GROUP BY Date.Year, Date.Quarter, OrderDetail.CustomerID
+      ORDER BY Year, Quarter;
+    """
+    else:
+        sql_statement = """
       SELECT
       CASE 
       WHEN CAST(strftime('%m', ORDERDATE) AS INT) BETWEEN 4 AND 6 THEN 'Q2'
@@ -569,11 +2019,13 @@ def ex8(conn):
       ORDER BY Year, Quarter;
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex9(conn):
+@instrumented
+def ex9(conn, execute=True):
 
     # Rank the customer sales by Quarter and year, but only select the top 5 customers!
     # Output Columns: Quarter, Year, CustomerID, Total
@@ -584,7 +2036,23 @@ def ex9(conn):
     # WITH table1 AS (), table2 AS ()
     ### BEGIN SOLUTION
 
-    sql_statement = """
+    if table_exists(conn, "QuarterlySales"):
+        sql_statement = """
+      SELECT t2.* FROM ( SELECT t1.*, Rank() OVER (PARTITION BY Year, Quarter ORDER BY TOTAL DESC) as CustomerRank FROM (
+      SELECT Quarter, Year, CustomerID, ROUND(Total, 0) as Total FROM QuarterlySales) t1 ) t2 WHERE CustomerRank <= 5
+      ORDER BY Year, Quarter;
+    """
+    elif table_exists(conn, "Date"):
+        sql_statement = """
+      SELECT t2.* FROM ( SELECT t1.*, Rank() OVER (PARTITION BY Year, Quarter ORDER BY TOTAL DESC) as CustomerRank FROM (
+      SELECT 'Q' || Date.Quarter as Quarter, Date.Year, OrderDetail.CustomerID, ROUND(SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice), 0) as Total FROM OrderDetail
+      JOIN Date ON OrderDetail.DateKey = Date.DateKey
+      JOIN Product ON OrderDetail.ProductID = Product.ProductID
+      GROUP BY Date.Year, Date.Quarter, OrderDetail.CustomerID) t1 ) t2 WHERE CustomerRank <= 5
+      ORDER BY Year, Quarter;
+    """
+    else:
+        sql_statement = """
       SELECT t2.* FROM ( SELECT t1.*, Rank() OVER (PARTITION BY Year, Quarter ORDER BY TOTAL DESC) as CustomerRank FROM ( SELECT
       CASE 
       WHEN CAST(strftime('%m', ORDERDATE) AS INT) BETWEEN 4 AND 6 THEN 'Q2'
@@ -598,11 +2066,13 @@ def ex9(conn):
       ORDER BY Year, Quarter;
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex10(conn):
+@instrumented
+def ex10(conn, execute=True):
 
     # Rank the monthly sales
     # Output Columns: Quarter, Year, CustomerID, Total
@@ -610,7 +2080,25 @@ def ex10(conn):
     # Hint: Round the the total
     ### BEGIN SOLUTION
 
-    sql_statement = """
+    if table_exists(conn, "MonthlySales"):
+        sql_statement = """
+      SELECT t2.* FROM ( SELECT t1.*, Rank() OVER ( ORDER BY TOTAL DESC ) as TotalRank FROM (
+      SELECT Month, Total FROM MonthlySales) t1
+      ) t2
+    ORDER BY TotalRank;
+    """
+    elif table_exists(conn, "Date"):
+        sql_statement = """
+      SELECT t2.* FROM ( SELECT t1.*, Rank() OVER ( ORDER BY TOTAL DESC ) as TotalRank FROM (
+      SELECT Date.MonthName as Month, SUM(ROUND(OrderDetail.QuantityOrdered * Product.ProductUnitPrice)) AS Total FROM OrderDetail
+      JOIN Date ON OrderDetail.DateKey = Date.DateKey
+      JOIN Product ON OrderDetail.ProductID = Product.ProductID
+      GROUP BY Date.Month) t1
+      ) t2
+    ORDER BY TotalRank;
+    """
+    else:
+        sql_statement = """
       SELECT t2.* FROM ( SELECT t1.*, Rank() OVER ( ORDER BY TOTAL DESC ) as TotalRank FROM ( SELECT
       CASE
       WHEN CAST(strftime('%m', ORDERDATE) AS INT) = 1 THEN 'January'
@@ -634,11 +2122,13 @@ def ex10(conn):
     """
 
     ### END SOLUTION ROUND(SUM(OrderDetail.QuantityOrdered * Product.ProductUnitPrice), 1)
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
 
 
-def ex11(conn):
+@instrumented
+def ex11(conn, execute=True):
 
     # Find the MaxDaysWithoutOrder for each customer
     # Output Columns:
@@ -655,19 +2145,214 @@ def ex11(conn):
 
     ### BEGIN SOLUTION
 
+    # One LAG pass walks each customer's order lines in OrderDate order
+    # straight off the OrderDetail_CustomerID index, so it needs no sort. The
+    # gap rows are ranked once, largest gap first and the earliest such order
+    # on ties, and only each customer's top row is joined to Customer and
+    # Country. See max_days_without_order for the same report in NumPy.
     sql_statement = """
-     SELECT t2.CustomerID, t2.FirstName, t2.LastName, t2.Country, t2.OrderDate, t2.PreviousOrderDate, ROUND(t2.MaxDaysWithoutOrder, 0) MaxDaysWithoutOrder FROM ( SELECT t3.*, RANK() OVER ( PARTITION BY CustomerID ORDER BY t3.OrderDate ) RN1 FROM ( SELECT t4.* FROM ( SELECT t1.*, RANK() OVER ( PARTITION BY CustomerID ORDER BY MaxDaysWithoutOrder DESC ) RN FROM ( SELECT Customer.CustomerID, FirstName, LastName, Country.Country, OrderDetail.OrderDate, Lag(OrderDetail.OrderDate) OVER (PARTITION BY Customer.CustomerID ORDER BY OrderDetail.OrderDate) as PreviousOrderDate, CAST((julianday(OrderDetail.OrderDate) - julianday(Lag(OrderDetail.OrderDate) OVER (PARTITION BY Customer.CustomerID ORDER BY OrderDetail.OrderDate))) AS INT) as MaxDaysWithoutOrder
-     FROM Customer
-     JOIN Country ON Customer.CountryID = Country.CountryID
-     JOIN OrderDetail ON Customer.CustomerID = OrderDetail.CustomerID 
+     WITH Gaps AS (
+       SELECT CustomerID, OrderDate, Lag(OrderDate) OVER CustomerOrders AS PreviousOrderDate,
+       CAST(julianday(OrderDate) - julianday(Lag(OrderDate) OVER CustomerOrders) AS INT) AS DaysWithoutOrder
+       FROM OrderDetail
+       WINDOW CustomerOrders AS (PARTITION BY CustomerID ORDER BY OrderDate)
+     ), RankedGaps AS (
+       SELECT Gaps.*, ROW_NUMBER() OVER (PARTITION BY CustomerID ORDER BY DaysWithoutOrder DESC, OrderDate) AS GapRank
+       FROM Gaps
+       WHERE PreviousOrderDate IS NOT NULL
      )
-     t1
-     WHERE MaxDaysWithoutOrder IS NOT NULL ) t4 
-     WHERE RN = 1 ) t3) t2
-     WHERE RN1 = 1
-     ORDER BY MaxDaysWithoutOrder DESC, t2.CustomerID DESC
+     SELECT Customer.CustomerID, Customer.FirstName, Customer.LastName, Country.Country, RankedGaps.OrderDate, RankedGaps.PreviousOrderDate, ROUND(RankedGaps.DaysWithoutOrder, 0) MaxDaysWithoutOrder
+     FROM RankedGaps
+     JOIN Customer ON RankedGaps.CustomerID = Customer.CustomerID
+     JOIN Country ON Customer.CountryID = Country.CountryID
+     WHERE RankedGaps.GapRank = 1
+     ORDER BY MaxDaysWithoutOrder DESC, Customer.CustomerID DESC
      ;
     """
     ### END SOLUTION
-    df = pd.read_sql_query(sql_statement, conn)
+    if execute:
+        df = run_report_query(sql_statement, conn)
     return sql_statement
+
+
+def max_days_without_order(conn, chunksize=100000):
+    # The ex11 report computed in NumPy instead of SQL, for comparison. The
+    # order lines are streamed sorted by CustomerID and OrderDate, chunksize
+    # rows at a time; each chunk's gaps are vectorized and only every
+    # customer's best gap so far is kept between chunks.
+    # Inputs: Open connection and the number of order lines fetched at a time
+    # Output: DataFrame with the same columns and rows as ex11's result
+
+    best = {}
+    last_customer_id, last_order_date = None, None
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT CustomerID, OrderDate FROM OrderDetail ORDER BY CustomerID, OrderDate;"
+    )
+    while True:
+        rows = cur.fetchmany(chunksize)
+        if not rows:
+            break
+        customer_ids, order_dates = zip(*rows)
+        if last_customer_id is not None:
+            customer_ids = (last_customer_id,) + customer_ids
+            order_dates = (last_order_date,) + order_dates
+        last_customer_id, last_order_date = customer_ids[-1], order_dates[-1]
+
+        customer_ids = np.array(customer_ids)
+        days = np.array(order_dates, dtype="datetime64[D]").astype(np.int64)
+        gaps = np.diff(days)
+        # Positions (in the chunk) of order lines that follow another order
+        # line of the same customer
+        positions = np.flatnonzero(customer_ids[1:] == customer_ids[:-1]) + 1
+        if not len(positions):
+            continue
+        gap_customer_ids = customer_ids[positions]
+        gaps = gaps[positions - 1]
+
+        # Per customer the first position holding its largest gap, i.e. the
+        # earliest order on ties, as in ex11
+        starts = np.flatnonzero(
+            np.r_[True, gap_customer_ids[1:] != gap_customer_ids[:-1]]
+        )
+        max_gaps = np.maximum.reduceat(gaps, starts)
+        is_max = gaps == np.repeat(max_gaps, np.diff(np.r_[starts, len(gaps)]))
+        max_positions = np.flatnonzero(is_max)
+        first_max = max_positions[np.searchsorted(max_positions, starts)]
+
+        for customer_id, gap, position in zip(
+            gap_customer_ids[starts].tolist(),
+            max_gaps.tolist(),
+            positions[first_max].tolist(),
+        ):
+            if customer_id not in best or gap > best[customer_id][0]:
+                best[customer_id] = (
+                    gap,
+                    order_dates[position],
+                    order_dates[position - 1],
+                )
+
+    gaps = pd.DataFrame(
+        [
+            (customer_id, order_date, previous_order_date, float(gap))
+            for customer_id, (gap, order_date, previous_order_date) in best.items()
+        ],
+        columns=["CustomerID", "OrderDate", "PreviousOrderDate", "MaxDaysWithoutOrder"],
+    )
+    customers = pd.read_sql_query(
+        "SELECT Customer.CustomerID, FirstName, LastName, Country "
+        "FROM Customer JOIN Country ON Customer.CountryID = Country.CountryID;",
+        conn,
+    )
+    return (
+        customers.merge(gaps, on="CustomerID")
+        .sort_values(["MaxDaysWithoutOrder", "CustomerID"], ascending=False)
+        .reset_index(drop=True)
+    )
+
+
+# The report functions by name. Called with execute=False they only build and
+# return their SQL statement; ex1 and ex2 also take the CustomerName.
+REPORTS = {
+    "ex1": ex1,
+    "ex2": ex2,
+    "ex3": ex3,
+    "ex4": ex4,
+    "ex5": ex5,
+    "ex6": ex6,
+    "ex7": ex7,
+    "ex8": ex8,
+    "ex9": ex9,
+    "ex10": ex10,
+    "ex11": ex11,
+}
+
+
+REPORT_CHUNK_SIZE = 10000
+
+
+def iter_report(conn, name, *args, chunksize=REPORT_CHUNK_SIZE):
+    # Streams a report's result instead of building it as one DataFrame: the
+    # rows are fetched from the cursor chunksize at a time, so memory stays
+    # bounded by the chunk size whatever the size of the result.
+    # Inputs: Open connection, report name, the report's arguments and the
+    # number of rows per chunk
+    # Output: Generator of DataFrames of at most chunksize rows each
+
+    cur = conn.cursor()
+    cur.execute(REPORTS[name](conn, *args, execute=False))
+    columns = [column[0] for column in cur.description]
+    try:
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows:
+                break
+            count_rows("rows_returned", len(rows))
+            yield pd.DataFrame.from_records(rows, columns=columns)
+    finally:
+        cur.close()
+
+
+def explain_report(conn, name, *args):
+    # Runs EXPLAIN QUERY PLAN for a report and flags the plan steps that read a
+    # whole table (table_scan, or index_scan when it walks a whole index of the
+    # table instead), build a transient index (automatic_index) or sort rows
+    # into a temporary B-tree for ORDER BY, GROUP BY or DISTINCT (temp_btree).
+    # Scans of subqueries and CTEs are not flagged, their cost shows up in the
+    # steps that fill them.
+    # Inputs: Open connection, report name and the report's arguments
+    # Output: DataFrame with the id, parent and detail of every plan step and
+    # the four flag columns
+
+    plan = pd.read_sql_query(
+        "EXPLAIN QUERY PLAN " + REPORTS[name](conn, *args, execute=False), conn
+    )[["id", "parent", "detail"]]
+
+    subqueries = plan["detail"].str.extract(r"^(?:CO-ROUTINE|MATERIALIZE) (.+)$")[0]
+    scanned = plan["detail"].str.extract(r"^SCAN (\S+)")[0]
+    table_scans = scanned.notna() & ~scanned.isin(subqueries.dropna())
+    table_scans &= ~scanned.str.startswith("(", na=False)
+    uses_index = plan["detail"].str.contains(r" USING (?:COVERING )?INDEX ")
+
+    plan["table_scan"] = table_scans & ~uses_index
+    plan["index_scan"] = table_scans & uses_index
+    plan["automatic_index"] = plan["detail"].str.contains("AUTOMATIC")
+    plan["temp_btree"] = plan["detail"].str.startswith("USE TEMP B-TREE")
+    return plan
+
+
+def inspect_reports(conn, CustomerName, runs=5):
+    # Diagnostic run over every report: the flagged steps of its query plan,
+    # see explain_report, and its execution time over runs runs.
+    # Inputs: Open connection, the CustomerName passed to ex1 and ex2, and the
+    # number of timed runs per report
+    # Output: DataFrame with one row per report: the best and median seconds,
+    # the row count and the detail of the flagged plan steps
+    import statistics
+
+    reports = []
+    for name in REPORTS:
+        args = (CustomerName,) if name in ("ex1", "ex2") else ()
+        plan = explain_report(conn, name, *args)
+        sql_statement = REPORTS[name](conn, *args, execute=False)
+        seconds = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            df = pd.read_sql_query(sql_statement, conn)
+            seconds.append(time.perf_counter() - start)
+
+        report = {
+            "report": name,
+            "best_seconds": min(seconds),
+            "median_seconds": statistics.median(seconds),
+            "rows": len(df),
+        }
+        for flag, column in [
+            ("table_scan", "table_scans"),
+            ("index_scan", "index_scans"),
+            ("automatic_index", "automatic_indexes"),
+            ("temp_btree", "temp_btrees"),
+        ]:
+            report[column] = plan.loc[plan[flag], "detail"].tolist()
+        reports.append(report)
+    return pd.DataFrame(reports)
@@ -0,0 +1,348 @@
+### Benchmark for the normalization pipeline in SQL_Normalization.py
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import SQL_Normalization
+from SQL_Normalization import (
+    create_connection,
+    execute_sql_statement,
+    inspect_reports,
+)
+
+HEADER = [
+    "Name",
+    "Address",
+    "City",
+    "Country",
+    "Region",
+    "ProductName",
+    "ProductCategory",
+    "ProductCategoryDescription",
+    "ProductUnitPrice",
+    "QuantityOrderded",
+    "OrderDate",
+]
+
+REGIONS = {
+    "British Isles": ["UK", "Ireland"],
+    "Central America": ["Mexico"],
+    "Eastern Europe": ["Poland"],
+    "North America": ["USA", "Canada"],
+    "Northern Europe": ["Sweden", "Finland", "Norway", "Denmark"],
+    "Scandinavia": ["Iceland"],
+    "South America": ["Brazil", "Argentina", "Venezuela"],
+    "Southern Europe": ["Spain", "Italy", "Portugal"],
+    "Western Europe": ["Germany", "France", "Belgium", "Austria", "Switzerland"],
+}
+
+FIRST_NAMES = [
+    "Maria", "Ana", "Antonio", "Thomas", "Christina", "Hanna", "Frederique",
+    "Martin", "Laurence", "Elizabeth", "Victoria", "Patricio", "Francisco",
+    "Yang", "Pedro", "Aria", "Diego", "Peter", "Carine", "Paolo",
+]  # fmt: skip
+
+LAST_NAMES = [
+    "Anders", "Trujillo", "Moreno", "Hardy", "Berglund", "Moos", "Citeaux",
+    "Sommer", "Lebihan", "Lincoln", "Ashworth", "Simpson", "Chang", "Wang",
+    "Afonso", "Cruz", "Roel", "Franken", "Schmitt", "Accorti",
+]  # fmt: skip
+
+PRODUCT_CATEGORIES = {
+    "Beverages": "Soft drinks, coffees, teas, beers, and ales",
+    "Condiments": "Sweet and savory sauces, relishes, spreads, and seasonings",
+    "Confections": "Desserts, candies, and sweet breads",
+    "Dairy Products": "Cheeses",
+    "Grains/Cereals": "Breads, crackers, pasta, and cereal",
+    "Meat/Poultry": "Prepared meats",
+    "Produce": "Dried fruit and bean curd",
+    "Seafood": "Seaweed and fish",
+}
+
+PRESET_ROWS = {"10K": 10000, "1M": 1000000, "10M": 10000000}
+
+GENERATE_BATCH_SIZE = 100000
+
+
+def parse_rows(rows):
+    # Inputs: Row count such as "10K", "1M", "10M" or "250000"
+    # Output: The row count as an int
+
+    if rows.upper() in PRESET_ROWS:
+        return PRESET_ROWS[rows.upper()]
+    return int(rows)
+
+
+def generate_sales_data(data_filename, rows, customers=None, products=77, seed=0):
+    # Writes a synthetic tab separated sales file in the layout read_data
+    # expects: one row per order with the customer columns followed by the
+    # ;-joined product, category, description, unit price, quantity and
+    # YYYYMMDD order date of its one to five order lines.
+    # Inputs: Name of the data file to write, number of rows, number of distinct
+    # customers (rows // 50 by default) and products, and the random seed
+    # Output: None
+
+    rng = np.random.default_rng(seed)
+    if customers is None:
+        customers = max(len(FIRST_NAMES), rows // 50)
+
+    countries = [
+        (country, region)
+        for region, region_countries in REGIONS.items()
+        for country in region_countries
+    ]
+    customer_columns = []
+    for i in range(customers):
+        first_name = FIRST_NAMES[i % len(FIRST_NAMES)]
+        last_name = LAST_NAMES[(i // len(FIRST_NAMES)) % len(LAST_NAMES)]
+        if i >= len(FIRST_NAMES) * len(LAST_NAMES):
+            last_name = "%s %d" % (last_name, i)
+        country, region = countries[rng.integers(len(countries))]
+        customer_columns.append(
+            "\t".join(
+                [
+                    "%s %s" % (first_name, last_name),
+                    "%d %s Street"
+                    % (rng.integers(1, 1000), LAST_NAMES[i % len(LAST_NAMES)]),
+                    "%s City %d" % (country, i % 7),
+                    country,
+                    region,
+                ]
+            )
+        )
+
+    categories = list(PRODUCT_CATEGORIES)
+    product_names = []
+    product_categories = []
+    product_descriptions = []
+    product_unit_prices = []
+    for i in range(products):
+        category = categories[i % len(categories)]
+        product_names.append("%s No. %d" % (category.split("/")[0], i + 1))
+        product_categories.append(category)
+        product_descriptions.append(PRODUCT_CATEGORIES[category])
+        product_unit_prices.append("%.2f" % rng.uniform(2.5, 265.0))
+
+    first_day = datetime.date(2010, 1, 1)
+    order_dates = [
+        (first_day + datetime.timedelta(days)).strftime("%Y%m%d")
+        for days in range((datetime.date(2016, 12, 31) - first_day).days + 1)
+    ]
+
+    with open(data_filename, "w") as data_file:
+        data_file.write("\t".join(HEADER) + "\n")
+        for batch_start in range(0, rows, GENERATE_BATCH_SIZE):
+            batch_rows = min(GENERATE_BATCH_SIZE, rows - batch_start)
+            customer_ids = rng.integers(customers, size=batch_rows)
+            line_counts = rng.integers(1, 6, size=batch_rows)
+            ends = np.cumsum(line_counts).tolist()
+            product_ids = rng.integers(products, size=ends[-1]).tolist()
+            quantities = rng.integers(1, 100, size=ends[-1]).astype(str).tolist()
+            date_ids = rng.integers(len(order_dates), size=ends[-1]).tolist()
+
+            lines = []
+            start = 0
+            for customer_id, end in zip(customer_ids.tolist(), ends):
+                order_products = product_ids[start:end]
+                lines.append(
+                    "\t".join(
+                        [
+                            customer_columns[customer_id],
+                            ";".join(product_names[p] for p in order_products),
+                            ";".join(product_categories[p] for p in order_products),
+                            ";".join(product_descriptions[p] for p in order_products),
+                            ";".join(product_unit_prices[p] for p in order_products),
+                            ";".join(quantities[start:end]),
+                            ";".join(order_dates[d] for d in date_ids[start:end]),
+                        ]
+                    )
+                )
+                start = end
+            data_file.write("\n".join(lines) + "\n")
+
+
+def time_call(function, *args, **kwargs):
+    # Output: Wall-clock seconds the call took
+
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def benchmark_steps(data_filename, normalized_database_filename, **kwargs):
+    # Times step1 ... step11 run in order against a fresh database.
+    # Inputs: Name of the data and normalized database filename, and keyword
+    # arguments passed to step11 (chunksize, processes, ...)
+    # Output: Dict of step function name to seconds
+
+    create_connection(normalized_database_filename, delete_db=True).close()
+    timings = {}
+    for step in range(1, 12):
+        name = next(
+            name
+            for name in dir(SQL_Normalization)
+            if name.startswith("step%d_" % step)
+        )
+        if step % 2:
+            args = (data_filename, normalized_database_filename)
+        else:
+            args = (normalized_database_filename,)
+        timings[name] = time_call(
+            getattr(SQL_Normalization, name),
+            *args,
+            **(kwargs if step == 11 else {}),
+        )
+    return timings
+
+
+def benchmark_normalize(data_filename, normalized_database_filename, **kwargs):
+    # Inputs: Name of the data and normalized database filename, and keyword
+    # arguments passed to normalize
+    # Output: Dict with the seconds normalize took
+
+    create_connection(normalized_database_filename, delete_db=True).close()
+    return {
+        "normalize": time_call(
+            SQL_Normalization.normalize,
+            data_filename,
+            normalized_database_filename,
+            **kwargs,
+        )
+    }
+
+
+def benchmark_reports(normalized_database_filename, repeat=3):
+    # Runs every ex report repeat times through inspect_reports. ex1 and ex2
+    # report on the customer with CustomerID 1.
+    # Inputs: Normalized database filename and number of runs per report
+    # Output: Dict of report name to the best and median seconds, row count and
+    # the flagged steps of its query plan
+
+    conn = create_connection(normalized_database_filename)
+    customer_name = execute_sql_statement(
+        "select FirstName || ' ' || LastName from Customer where CustomerID = 1;",
+        conn,
+    )[0][0]
+    reports = inspect_reports(conn, customer_name, repeat)
+    conn.close()
+    return {report.pop("report"): report for report in reports.to_dict("records")}
+
+
+def run_benchmark(rows, work_dir, mode="steps", repeat=3, keep=False, **kwargs):
+    # Generates a data file of the given size (reused if it is already in
+    # work_dir), builds the normalized database and times the reports.
+    # Inputs: Number of rows, directory for the data and database files,
+    # "steps" or "normalize", runs per report, whether to keep the files, and
+    # keyword arguments passed to step11 or normalize
+    # Output: Dict with the sizes and timings of the run
+
+    data_filename = os.path.join(work_dir, "sales_%d.tsv" % rows)
+    normalized_database_filename = os.path.join(work_dir, "sales_%d.db" % rows)
+
+    result = {"rows": rows, "mode": mode, "options": kwargs}
+    if not os.path.exists(data_filename):
+        result["generate"] = time_call(generate_sales_data, data_filename, rows)
+    result["data_bytes"] = os.path.getsize(data_filename)
+
+    if mode == "steps":
+        result["build"] = benchmark_steps(
+            data_filename, normalized_database_filename, **kwargs
+        )
+    else:
+        result["build"] = benchmark_normalize(
+            data_filename, normalized_database_filename, **kwargs
+        )
+    result["build_total"] = sum(result["build"].values())
+    result["database_bytes"] = os.path.getsize(normalized_database_filename)
+
+    conn = create_connection(normalized_database_filename)
+    result["order_lines"] = execute_sql_statement(
+        "select count(*) from OrderDetail;", conn
+    )[0][0]
+    conn.close()
+    result["reports"] = benchmark_reports(normalized_database_filename, repeat)
+
+    if not keep:
+        for filename in [data_filename, normalized_database_filename]:
+            for suffix in ["", "-wal", "-shm"]:
+                if os.path.exists(filename + suffix):
+                    os.remove(filename + suffix)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark SQL_Normalization.py on synthetic sales data."
+    )
+    parser.add_argument(
+        "--rows",
+        nargs="+",
+        default=["10K"],
+        help="data sizes to run, e.g. 10K 1M 10M or a plain row count",
+    )
+    parser.add_argument("--mode", choices=["steps", "normalize"], default="steps")
+    parser.add_argument("--chunksize", type=int)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--no-indexes", action="store_true")
+    parser.add_argument("--materialize-summaries", action="store_true")
+    parser.add_argument("--in-memory", action="store_true", help="normalize mode only")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per report")
+    parser.add_argument("--work-dir", help="defaults to a temporary directory")
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the data and database files"
+    )
+    parser.add_argument("--output", help="JSON file to write instead of stdout")
+    args = parser.parse_args(argv)
+    if args.in_memory and args.mode != "normalize":
+        parser.error("--in-memory requires --mode normalize")
+
+    kwargs = {}
+    if args.chunksize:
+        kwargs["chunksize"] = args.chunksize
+    if args.processes:
+        kwargs["processes"] = args.processes
+    if args.no_indexes:
+        kwargs["create_indexes"] = False
+    if args.materialize_summaries:
+        kwargs["materialize_summaries"] = True
+    if args.in_memory:
+        kwargs["in_memory"] = True
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="normalization_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "runs": [
+            run_benchmark(
+                parse_rows(rows), work_dir, args.mode, args.repeat, args.keep, **kwargs
+            )
+            for rows in args.rows
+        ],
+    }
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    if not args.keep and not args.work_dir:
+        os.rmdir(work_dir)
+
+
+if __name__ == "__main__":
+    main()
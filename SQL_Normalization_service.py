@@ -0,0 +1,330 @@
+### Report service over a normalized database built by SQL_Normalization.py
+import asyncio
+import pandas as pd
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+from SQL_Normalization import REPORT_CHUNK_SIZE, REPORTS, iter_report
+
+
+def create_read_only_connection(
+    db_file, cache_size_kib=65536, mmap_size=268435456, cached_statements=128
+):
+    # Inputs: Database filename, page cache size in KiB, memory-map size in bytes
+    # and the number of prepared statements sqlite3 keeps per connection
+    # Output: Read-only connection that may be handed between threads
+
+    conn = sqlite3.connect(
+        "file:%s?mode=ro" % pathname2url(db_file),
+        uri=True,
+        check_same_thread=False,
+        cached_statements=cached_statements,
+    )
+    conn.execute("PRAGMA cache_size = -%d" % cache_size_kib)
+    conn.execute("PRAGMA mmap_size = %d" % mmap_size)
+    return conn
+
+
+class ReportService:
+    # Serves the ex1-ex11 reports from a fixed pool of read-only connections.
+    # The database is switched to WAL mode once so readers never block on, or
+    # are blocked by, a load. The SQL of the reports without parameters is
+    # built once and kept by report name; sqlite3 then reuses the prepared
+    # statement cached on each connection for that SQL text. ex1 and ex2 embed
+    # the looked-up CustomerIDs, so their SQL is built on every call.
+    #
+    # Report results are kept in an LRU cache of result_cache_size entries keyed
+    # by report name and arguments. Every load bumps the database's load
+    # generation (PRAGMA user_version); when a call sees a new generation both
+    # caches are emptied, so results never outlive the data they came from.
+
+    def __init__(
+        self,
+        normalized_database_filename,
+        pool_size=4,
+        cache_size_kib=65536,
+        mmap_size=268435456,
+        result_cache_size=256,
+    ):
+        conn = sqlite3.connect(normalized_database_filename)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.close()
+
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(
+                create_read_only_connection(
+                    normalized_database_filename, cache_size_kib, mmap_size
+                )
+            )
+        self._pool_size = pool_size
+        self._connection_args = (
+            normalized_database_filename,
+            cache_size_kib,
+            mmap_size,
+        )
+        self._statements = {}
+        self._statements_lock = threading.Lock()
+        self._results = OrderedDict()
+        self._result_cache_size = result_cache_size
+        self._results_lock = threading.Lock()
+        self._generation = None
+
+    @contextmanager
+    def connection(self):
+        # Output: A pooled connection for the duration of the with block,
+        # waiting for one to be returned when all of them are in use
+
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def report_sql(self, conn, name, *args, generation=None):
+        # Inputs: Pooled connection, report name ("ex1" ... "ex11"), the
+        # report's arguments (the CustomerName of ex1 and ex2) and the load
+        # generation the caller saw, read with check_generation by default
+        # Output: The report's SQL statement. Cached SQL is kept with the
+        # generation it was built under and only reused for that generation, so
+        # SQL built just before a load cannot be stored after the load emptied
+        # the cache and then outlive it.
+
+        if args:
+            return REPORTS[name](conn, *args, execute=False)
+
+        if generation is None:
+            generation = self.check_generation(conn)
+        with self._statements_lock:
+            cached = self._statements.get(name)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        sql_statement = REPORTS[name](conn, execute=False)
+        with self._statements_lock:
+            self._statements[name] = (generation, sql_statement)
+        return sql_statement
+
+    def clear_statements(self):
+        # Forgets the cached SQL, e.g. after a rebuild added summary tables
+
+        with self._statements_lock:
+            self._statements.clear()
+
+    def check_generation(self, conn):
+        # Empties the statement and result caches if a load has completed since
+        # they were filled.
+        # Inputs: Pooled connection
+        # Output: The load generation conn sees
+
+        generation = conn.execute("PRAGMA user_version").fetchone()[0]
+        with self._results_lock:
+            if generation == self._generation:
+                return generation
+            self._results.clear()
+            self._generation = generation
+        self.clear_statements()
+        return generation
+
+    def report(self, name, *args):
+        # Inputs: Report name and its arguments
+        # Output: DataFrame with the report result, served from the result cache
+        # when the same report was run since the last load
+
+        with self.connection() as conn:
+            return self.run_report(conn, name, *args)
+
+    def run_report(self, conn, name, *args):
+        # report() on a connection the caller already holds
+        # Inputs: Connection, report name and its arguments
+        # Output: DataFrame with the report result
+
+        key = (name,) + args
+        self.check_generation(conn)
+        with self._results_lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key].copy()
+            generation = self._generation
+
+        df = pd.read_sql_query(
+            self.report_sql(conn, name, *args, generation=generation), conn
+        )
+
+        with self._results_lock:
+            if generation == self._generation and self._result_cache_size:
+                self._results[key] = df
+                if len(self._results) > self._result_cache_size:
+                    self._results.popitem(last=False)
+        return df.copy()
+
+    def iter_report(self, name, *args, chunksize=REPORT_CHUNK_SIZE):
+        # Streams a report in chunks, see SQL_Normalization.iter_report. The
+        # result is not cached. The chunks are read through a connection of
+        # their own rather than a pooled one, closed when the generator is
+        # exhausted, closed or garbage collected, so iterators a caller abandons
+        # never keep report() waiting for a connection.
+        # Inputs: Report name, its arguments and the number of rows per chunk
+        # Output: Generator of DataFrames of at most chunksize rows each
+
+        conn = create_read_only_connection(*self._connection_args)
+        try:
+            self.check_generation(conn)
+            yield from iter_report(conn, name, *args, chunksize=chunksize)
+        finally:
+            conn.close()
+
+    def close(self):
+        for _ in range(self._pool_size):
+            self._pool.get().close()
+
+
+class AsyncReportService:
+    # asyncio front end to the reports. Queries run on a fixed pool of worker
+    # threads, each with its own read-only connection for its whole life, so
+    # the event loop never blocks on SQLite. At most max_pending requests are
+    # in flight; further callers wait for a slot, which pushes back on a busy
+    # server instead of queueing without bound. Cancelling a request (e.g. by
+    # asyncio.wait_for) interrupts its running query; its slot is only freed
+    # once the worker has stopped. Results and SQL are cached as in
+    # ReportService; iter_report streams a report chunk by chunk.
+
+    def __init__(
+        self,
+        normalized_database_filename,
+        workers=4,
+        max_pending=None,
+        cache_size_kib=65536,
+        mmap_size=268435456,
+        result_cache_size=256,
+    ):
+        self._service = ReportService(
+            normalized_database_filename,
+            pool_size=0,
+            result_cache_size=result_cache_size,
+        )
+        self._connection_args = (
+            normalized_database_filename,
+            cache_size_kib,
+            mmap_size,
+        )
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="report",
+            initializer=self._open_connection,
+        )
+        self._slots = asyncio.Semaphore(max_pending or workers * 4)
+
+    def _open_connection(self):
+        # Runs once in every worker thread
+        conn = create_read_only_connection(*self._connection_args)
+        self._local.conn = conn
+        with self._connections_lock:
+            self._connections.append(conn)
+
+    async def report(self, name, *args):
+        # Inputs: Report name ("ex1" ... "ex11") and its arguments
+        # Output: DataFrame with the report result
+
+        # The connection running the request, guarded so a late cancellation
+        # cannot interrupt the next query on the same connection
+        running = {"conn": None, "cancelled": False}
+        running_lock = threading.Lock()
+
+        def run():
+            conn = self._local.conn
+            with running_lock:
+                if running["cancelled"]:
+                    raise asyncio.CancelledError()
+                running["conn"] = conn
+            try:
+                return self._service.run_report(conn, name, *args)
+            finally:
+                with running_lock:
+                    running["conn"] = None
+
+        try:
+            return await self._run(run)
+        except asyncio.CancelledError:
+            with running_lock:
+                running["cancelled"] = True
+                if running["conn"] is not None:
+                    running["conn"].interrupt()
+            raise
+
+    async def iter_report(self, name, *args, chunksize=REPORT_CHUNK_SIZE):
+        # Streams a report in chunks, see ReportService.iter_report. Each chunk
+        # is fetched on a worker thread and takes a slot only while it is being
+        # fetched, so a stream the caller stops reading holds no slot.
+        # Inputs: Report name, its arguments and the number of rows per chunk
+        # Output: Async generator of DataFrames of at most chunksize rows each
+
+        chunks = self._service.iter_report(name, *args, chunksize=chunksize)
+        # A cancelled fetch may still be running; close the stream after it
+        chunks_lock = threading.Lock()
+
+        def fetch():
+            with chunks_lock:
+                return next(chunks, None)
+
+        def close():
+            with chunks_lock:
+                chunks.close()
+
+        try:
+            while True:
+                chunk = await self._run(fetch)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            try:
+                self._executor.submit(close)
+            except RuntimeError:  # The service is already closed
+                close()
+
+    async def _run(self, function, *args):
+        # Runs function on a worker thread once one of the max_pending slots is
+        # free. The slot is released when the worker is done rather than when
+        # this coroutine is, so cancelled requests still count towards
+        # max_pending.
+        # Output: The function's return value
+
+        loop = asyncio.get_running_loop()
+        await self._slots.acquire()
+        try:
+            job = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        job.add_done_callback(
+            lambda job: loop.call_soon_threadsafe(self._slots.release)
+        )
+        return await asyncio.wrap_future(job)
+
+    async def customer_orders(self, CustomerName):
+        # Inputs: "FirstName LastName" of a customer
+        # Output: DataFrame with the customer's order lines (the ex1 report)
+
+        return await self.report("ex1", CustomerName)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._service.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)